@@ -1,13 +1,84 @@
 #!/usr/bin/env python3
 
 from abc import ABCMeta, abstractmethod
-from io import BytesIO
+import io
+import json
+import mmap
 import os
-
+import shutil
+import struct
+import tarfile
+import tempfile
+import threading
 import zipfile
+import zlib
 
 import rarfile
 
+import Paths
+
+zstd_magic = b"\x28\xb5\x2f\xfd"
+
+
+def open_stream(raw):
+    """Open a possibly compressed tar file object as a stream."""
+    if raw.read(4) == zstd_magic:
+        import zstandard
+        raw.seek(0)
+        stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        return tarfile.open(fileobj=stream, mode="r|")
+    raw.seek(0)
+    return tarfile.open(fileobj=raw, mode="r|*")
+
+
+def directory_size(path):
+    size = 0
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def evict(root, keep, quota):
+    """Remove the least recently used volume caches under root.
+
+    Every subdirectory of root is the cache of one volume; its ".used"
+    file is touched whenever the volume is opened and its ".complete"
+    file records its size once it is filled. Caches are removed oldest
+    first until they fit in quota bytes, never keep.
+    """
+    volumes = []
+    total = 0
+    for entry in os.scandir(root):
+        if not entry.is_dir():
+            continue
+        try:
+            with open(os.path.join(entry.path, ".complete")) as complete:
+                size = int(complete.read())
+        except (OSError, ValueError):
+            size = directory_size(entry.path)
+        try:
+            used = os.path.getmtime(os.path.join(entry.path, ".used"))
+        except OSError:
+            used = 0
+        volumes.append((used, entry.path, size))
+        total += size
+    for (used, path, size) in sorted(volumes):
+        if total <= quota:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def touch(cache):
+    with open(os.path.join(cache, ".used"), "w"):
+        pass
+
 
 def is_image(filename):
     return filename.lower().endswith("jpg") or \
@@ -16,7 +87,131 @@ def is_image(filename):
         filename.lower().endswith("gif")
 
 
+class MemoryFile(io.RawIOBase):
+    """Read-only file object over a buffer, without copying it.
+
+    io.BytesIO copies anything that is not a bytes object, which would
+    defeat handing out memoryview slices of an mmap.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        end = len(self.buffer)
+        if size is not None and size >= 0:
+            end = min(end, self.pos + size)
+        data = self.buffer[self.pos:end].tobytes()
+        self.pos = max(self.pos, end)
+        return data
+
+    def readinto(self, b):
+        data = self.buffer[self.pos:self.pos + len(b)]
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        # let the archive unmap its file once no page is open
+        try:
+            self.buffer.release()
+        except BufferError:
+            pass
+        io.RawIOBase.close(self)
+
+
+class Handles:
+    """One archive handle per thread, opened on demand.
+
+    ZipFile and RarFile objects keep file positions and state between
+    calls, so threads must not share them. get() returns the calling
+    thread's own handle.
+    """
+
+    def __init__(self, make):
+        self.make = make
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def get(self):
+        handle = getattr(self.local, "handle", None)
+        if handle is None:
+            handle = self.make()
+            self.local.handle = handle
+            with self.lock:
+                self.opened.append(handle)
+        return handle
+
+    def close(self):
+        with self.lock:
+            (opened, self.opened) = (self.opened, [])
+        for handle in opened:
+            try:
+                handle.close()
+            except Exception:
+                pass
+        self.local = threading.local()
+
+
+def close_map(map):
+    # pages still being decoded keep the map alive until they are done
+    try:
+        map.close()
+    except BufferError:
+        pass
+
+
 class Archive(metaclass=ABCMeta):
+    """A volume of pages.
+
+    Every archive takes an optional pages list, as a library catalog
+    records it, which list() then returns. With it, an archive does not
+    read its member directory or index until the first page is read.
+
+    open() and read() may be called from any number of threads at once;
+    processes open archives of their own, as the pre-pass and thumbnail
+    workers do. open() returns a file object to use as a context
+    manager; the archive itself is one too, and close() releases its
+    handles.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        pass
+
+    def load(self):
+        """Read the member directory or index now, not at the first page.
+
+        Call it before starting processes that open the archive
+        themselves, so they find whatever it built already there.
+        """
+        pass
+
     @abstractmethod
     def list(self):
         pass
@@ -25,29 +220,232 @@ class Archive(metaclass=ABCMeta):
     def open(self, filename):
         pass
 
+    def read(self, filename):
+        with self.open(filename) as imagefile:
+            return imagefile.read()
+
 
 class Rar(Archive):
-    def __init__(self, filename):
-        self.rar = rarfile.RarFile(filename)
+    """Rar archive, optionally extracted once into a page cache.
+
+    rarfile runs unrar for every member it reads, and solid archives are
+    decompressed from the start each time. With extract=True the whole
+    volume is unpacked by a single unrar run in a background thread, and
+    pages are read from the cache directory as soon as they are
+    complete. Extracted volumes are kept under ~/.cache and evicted least
+    recently used first once they exceed quota bytes.
+    """
+
+    def __init__(self, filename, extract=False, quota=2 * 1024 ** 3,
+                 pages=None):
+        self.rar = None
+        self.lock = threading.Lock()
+        self.handles = Handles(lambda: rarfile.RarFile(filename))
         self.path = filename
+        self.pages = pages
+        self.quota = quota
+        self.cache = None
+        if pages is None or extract:
+            self.directory()
+        if extract:
+            self.sizes = dict((info.filename, info.file_size)
+                              for info in self.rar.infolist())
+            self.cache = Paths.cache_dir("rar", Paths.file_key(filename))
+            touch(self.cache)
+            if not os.path.exists(os.path.join(self.cache, ".complete")):
+                threading.Thread(target=self.extract, daemon=True).start()
+
+    def load(self):
+        self.directory()
+
+    def directory(self):
+        """The RarFile of the volume, opened on first use."""
+        if self.rar is None:
+            with self.lock:
+                if self.rar is None:
+                    self.rar = rarfile.RarFile(self.path)
+        return self.rar
+
+    def extract(self):
+        # a handle of its own, so close() cannot pull it out from under
+        # a running extraction
+        try:
+            with rarfile.RarFile(self.path) as rar:
+                rar.extractall(path=os.path.join(self.cache, "pages"))
+        except (rarfile.Error, OSError):
+            return
+        with open(os.path.join(self.cache, ".complete"), "w") as complete:
+            complete.write(str(directory_size(self.cache)))
+        evict(os.path.dirname(self.cache), self.cache, self.quota)
+
+    def extracted(self, filename):
+        if self.cache is None:
+            return None
+        page = os.path.join(self.cache, "pages", filename)
+        try:
+            if os.path.getsize(page) == self.sizes[filename]:
+                return page
+        except (OSError, KeyError):
+            pass
+        return None
 
     def list(self):
-        return sorted([x for x in self.rar.namelist() if is_image(x)])
+        if self.pages is not None:
+            return list(self.pages)
+        return sorted([x for x in self.directory().namelist()
+                       if is_image(x)])
 
     def open(self, filename):
-        imagefile = self.rar.open(filename)
-        image = BytesIO()
-        image.write(imagefile.read())
-        imagefile.close()
-        image.seek(0)
-        return image
+        page = self.extracted(filename)
+        if page is not None:
+            return open(page, "rb")
+        return MemoryFile(self.read(filename))
+
+    def read(self, filename):
+        page = self.extracted(filename)
+        if page is not None:
+            return Archive.read(self, filename)
+        return self.handles.get().read(filename)
+
+    def close(self):
+        self.handles.close()
+        if self.rar is not None:
+            self.rar.close()
+
+
+class Tar(Archive):
+    """Tar archive with constant-time page access.
+
+    Uncompressed tars are scanned once for the data offset and size of
+    every image; the index is kept in the cache directory and pages are
+    sliced straight out of an mmap of the file. Compressed tars cannot
+    be seeked, so their images are extracted once into the cache
+    directory and read from there. Like unpacked rar volumes, cached
+    volumes are evicted least recently used first once they exceed
+    quota bytes.
+    """
+
+    def __init__(self, filename, quota=2 * 1024 ** 3, pages=None):
+        self.path = filename
+        self.pages = pages
+        self.quota = quota
+        self.map = None
+        self.index = None
+        self.lock = threading.Lock()
+        self.cache = Paths.cache_dir("tar", Paths.file_key(filename))
+        touch(self.cache)
+        if pages is None:
+            self.members()
+
+    def load(self):
+        self.members()
+
+    def members(self):
+        """The member index, loaded or built on first use."""
+        if self.index is None:
+            with self.lock:
+                if self.index is None:
+                    self.load_index()
+        return self.index["members"]
+
+    def load_index(self):
+        # other processes may be building the same index; everything is
+        # written under a private name and renamed into place, so they
+        # only ever see a finished index and page directory
+        index_file = os.path.join(self.cache, "index.json")
+        try:
+            with open(index_file, "r", encoding="utf-8") as index:
+                found = json.load(index)
+        except (OSError, ValueError):
+            found = self.build_index()
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8",
+                                             dir=self.cache, suffix=".tmp",
+                                             delete=False) as index:
+                json.dump(found, index)
+            os.replace(index.name, index_file)
+            with open(os.path.join(self.cache, ".complete"),
+                      "w") as complete:
+                complete.write(str(directory_size(self.cache)))
+            evict(os.path.dirname(self.cache), self.cache, self.quota)
+        if not found["extracted"]:
+            with open(self.path, "rb") as tar:
+                self.map = mmap.mmap(tar.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = found
+
+    def build_index(self):
+        with open(self.path, "rb") as tar:
+            magic = tar.read(4)
+        if magic != zstd_magic:
+            try:
+                with tarfile.open(self.path, "r:") as tar:
+                    members = dict()
+                    for member in tar:
+                        if member.isfile() and is_image(member.name):
+                            members[member.name] = (member.offset_data,
+                                                    member.size)
+                return {"extracted": False, "members": members}
+            except tarfile.ReadError:
+                pass
+        return {"extracted": True, "members": self.extract()}
+
+    def extract(self):
+        temp = tempfile.mkdtemp(prefix="pages.", dir=self.cache)
+        members = dict()
+        try:
+            with open(self.path, "rb") as raw:
+                with open_stream(raw) as tar:
+                    for member in tar:
+                        if not member.isfile() or \
+                                not is_image(member.name):
+                            continue
+                        # never trust member names as paths
+                        page = "%06d%s" % (len(members),
+                                           os.path.splitext(member.name)[1])
+                        with open(os.path.join(temp, page), "wb") as out:
+                            shutil.copyfileobj(tar.extractfile(member), out)
+                        members[member.name] = page
+            os.replace(temp, os.path.join(self.cache, "pages"))
+        except OSError:
+            # pages are named in archive order, so a directory another
+            # process moved into place first holds the same pages
+            if not os.path.isdir(os.path.join(self.cache, "pages")):
+                raise
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+        return members
+
+    def list(self):
+        if self.pages is not None:
+            return list(self.pages)
+        return sorted(self.members())
+
+    def open(self, filename):
+        members = self.members()
+        if self.index["extracted"]:
+            page = members[filename]
+            return open(os.path.join(self.cache, "pages", page), "rb")
+        return MemoryFile(self.read(filename))
+
+    def read(self, filename):
+        members = self.members()
+        if self.index["extracted"]:
+            return Archive.read(self, filename)
+        (offset, size) = members[filename]
+        return memoryview(self.map)[offset:offset + size]
+
+    def close(self):
+        if self.map is not None:
+            close_map(self.map)
 
 
 class Tree(Archive):
-    def __init__(self, dirname):
+    def __init__(self, dirname, pages=None):
         self.path = dirname
+        self.pages = pages
 
     def list(self):
+        if self.pages is not None:
+            return list(self.pages)
         return sorted([os.path.join(self.path, filename)
                        for filename in os.listdir(self.path)
                        if is_image(filename)])
@@ -58,16 +456,71 @@ class Tree(Archive):
 
 
 class Zip(Archive):
-    def __init__(self, filename):
-        self.zip = zipfile.ZipFile(filename)
+    """Zip archive read through an mmap of the file.
+
+    Stored members, which is how most CBZs are packed, are returned as
+    memoryview slices of the map. Deflated members are inflated from the
+    map straight into one buffer of the final size. Neither touches a
+    file position, so they need no locking; anything else is read
+    through a ZipFile of the calling thread's own.
+    """
+
+    def __init__(self, filename, pages=None):
+        self.zip = None
+        self.map = None
+        self.lock = threading.Lock()
+        self.handles = Handles(lambda: zipfile.ZipFile(filename))
         self.path = filename
+        self.pages = pages
+        if pages is None:
+            self.directory()
+
+    def load(self):
+        self.directory()
+
+    def directory(self):
+        """The ZipFile of the volume, opened and mapped on first use."""
+        if self.zip is None:
+            with self.lock:
+                if self.zip is None:
+                    with open(self.path, "rb") as archive:
+                        self.map = mmap.mmap(archive.fileno(), 0,
+                                             access=mmap.ACCESS_READ)
+                    self.zip = zipfile.ZipFile(self.path)
+        return self.zip
 
     def list(self):
-        return sorted([x for x in self.zip.namelist() if is_image(x)])
+        if self.pages is not None:
+            return list(self.pages)
+        return sorted([x for x in self.directory().namelist()
+                       if is_image(x)])
 
     def open(self, filename):
-        imagefile = self.zip.open(filename)
-        image = BytesIO()
-        image.write(imagefile.read())
-        image.seek(0)
-        return image
+        return MemoryFile(self.read(filename))
+
+    def data_offset(self, info):
+        # the local header repeats the name and may carry a different
+        # extra field than the central directory
+        header = info.header_offset
+        (name_length, extra_length) = struct.unpack(
+            "<HH", self.map[header + 26:header + 30])
+        return header + 30 + name_length + extra_length
+
+    def read(self, filename):
+        info = self.directory().getinfo(filename)
+        if info.flag_bits & 0x1:
+            return self.handles.get().read(filename)
+        if info.compress_type == zipfile.ZIP_STORED:
+            start = self.data_offset(info)
+            return memoryview(self.map)[start:start + info.file_size]
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            start = self.data_offset(info)
+            data = memoryview(self.map)[start:start + info.compress_size]
+            return zlib.decompress(data, -15, max(1, info.file_size))
+        return self.handles.get().read(filename)
+
+    def close(self):
+        self.handles.close()
+        if self.zip is not None:
+            self.zip.close()
+            close_map(self.map)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import re
+
+# longest line in the popup before glosses wrap, in characters
+width = 120
+
+
+def marked(text, role, match):
+    """Runs for text with the [start, end] part that matched set apart."""
+    if match is None:
+        return [(role, text)]
+    (start, end) = match
+    return [(r, t) for (r, t) in ((role, text[:start]),
+                                  ("match", text[start:end]),
+                                  (role, text[end:])) if t != ""]
+
+
+def kanji_runs(kanji):
+    runs = marked(kanji["text"], "kanji", kanji["match"])
+    if kanji["info"]:
+        runs.append(("subdue", "[%s]" % kanji["info"]))
+    return runs
+
+
+def reading_runs(reading):
+    runs = []
+    if reading["nokanji"]:
+        runs.append(("subdue", "＊"))
+    runs.extend(marked(reading["text"], "reading", reading["match"]))
+    if reading["info"]:
+        runs.append(("subdue", "[%s]" % reading["info"]))
+    return runs
+
+
+def joined(parts, separator):
+    runs = []
+    for part in parts:
+        if len(runs) > 0:
+            runs.append(("subdue", separator))
+        runs.extend(part)
+    return runs
+
+
+def headword_runs(entry):
+    readings = [reading_runs(r) for r in entry["readings"]]
+    if len(entry["kanjis"]) == 0:
+        return joined(readings, "、")
+    heads = []
+    restricted = any(r["restrictions"] for r in entry["readings"])
+    for kanji in entry["kanjis"]:
+        if restricted:
+            mine = [runs for (r, runs) in zip(entry["readings"], readings)
+                    if not r["restrictions"]
+                    or kanji["text"] in r["restrictions"]]
+            heads.append(kanji_runs(kanji) + [("subdue", "（")] +
+                         joined(mine, "、") + [("subdue", "）")])
+        else:
+            heads.append(kanji_runs(kanji))
+    runs = joined(heads, "；")
+    if not restricted:
+        runs += ([("subdue", "（")] + joined(readings, "、") +
+                 [("subdue", "）")])
+    return runs
+
+
+def runs(entry):
+    """Lay an entry out as (role, text) runs, as myougiden prints it.
+
+    Roles name what a run is (kanji, reading, match, subdue, misc,
+    highlight or plain text), so the renderer only maps them to
+    styles. Lines longer than width characters are broken at spaces.
+    """
+    out = []
+    if entry["frequent"]:
+        out += [("highlight", "※"), ("text", " ")]
+    out += headword_runs(entry)
+    for (number, sense) in enumerate(entry["senses"], start=1):
+        out += [("text", "\n"), ("misc", "%d." % number), ("text", " ")]
+        if sense["tags"]:
+            out += [("subdue", sense["tags"]), ("text", " ")]
+        out += joined([marked(gloss["text"], "text", gloss["match"])
+                       for gloss in sense["glosses"]], "; ")
+    return wrap(out)
+
+
+def wrap(runs):
+    wrapped = []
+    column = 0
+    for (role, text) in runs:
+        for piece in re.split("([ \n])", text):
+            if piece == "":
+                continue
+            if piece == "\n":
+                column = 0
+            elif column + len(piece) > width and column > 0:
+                wrapped.append(("text", "\n"))
+                column = 0
+                if piece == " ":
+                    continue
+            if piece != "\n":
+                column += len(piece)
+            wrapped.append((role, piece))
+    # merge what the split separated again
+    merged = []
+    for (role, text) in wrapped:
+        if merged and merged[-1][0] == role and text != "\n" and \
+                merged[-1][1] != "\n":
+            merged[-1] = (role, merged[-1][1] + text)
+        else:
+            merged.append((role, text))
+    return merged
+
+
+def text(entry):
+    """The entry as plain text."""
+    return "".join(t for (_, t) in runs(entry))
+
+
+def tsv(entry):
+    """The entry on one line, as myougiden's tab-separated output.
+
+    Readings, kanji and then every sense are separated by tabs; glosses
+    within a sense by "|", which is replaced inside glosses.
+    """
+    readings = "；".join("".join(t for (_, t) in reading_runs(reading))
+                        for reading in entry["readings"])
+    kanjis = "；".join("".join(t for (_, t) in kanji_runs(kanji))
+                      for kanji in entry["kanjis"])
+    fields = [readings, kanjis]
+    for sense in entry["senses"]:
+        glosses = "|".join(gloss["text"].replace("|", "¦")
+                           for gloss in sense["glosses"])
+        fields.append(sense["tags"] + " " + glosses if sense["tags"]
+                      else glosses)
+    line = "\t".join(fields)
+    if entry["frequent"]:
+        line += " (P)"
+    return line
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sqlite3
+import threading
+import zipfile
+
+import rarfile
+
+from Archive import Rar, Tar, Tree, Zip, is_image, open_stream, zstd_magic
+import Paths
+
+
+# leading bytes of the formats the reader opens
+signatures = [(b"PK\x03\x04", "zip"),
+              (b"PK\x05\x06", "zip"),
+              (b"Rar!\x1a\x07", "rar"),
+              (b"\x1f\x8b", "tar"),
+              (b"BZh", "tar"),
+              (b"\xfd7zXZ\x00", "tar"),
+              (zstd_magic, "tar")]
+
+
+def sniff(path):
+    """Return the volume kind of path ("tree", "zip", "tar" or "rar").
+
+    Returns None for anything the reader cannot open. Raises OSError
+    if path does not exist. The common formats are recognized from
+    their first bytes; libmagic is only loaded for anything else.
+    """
+    if os.path.isdir(path):
+        return "tree"
+    with open(path, "rb") as volume:
+        head = volume.read(512)
+    kind = None
+    for (signature, found) in signatures:
+        if head.startswith(signature):
+            kind = found
+            break
+    if kind in ("zip", "rar"):
+        return kind
+    if head[257:262] == b"ustar":
+        return "tar"
+    if kind == "tar":
+        # a compressed file is only a volume if it holds a tar
+        return "tar" if is_tar(path) else None
+    import magic
+    filetype = str(magic.from_file(path))
+    if "Zip archive data" in filetype:
+        return "zip"
+    elif "tar archive" in filetype:
+        return "tar"
+    elif "gzip compressed data" in filetype or \
+            "bzip2 compressed data" in filetype or \
+            "XZ compressed data" in filetype or \
+            "Zstandard compressed data" in filetype:
+        return "tar" if is_tar(path) else None
+    elif "RAR archive data" in filetype:
+        return "rar"
+    return None
+
+
+def is_tar(path):
+    try:
+        with open(path, "rb") as raw:
+            with open_stream(raw) as tar:
+                tar.next()
+    except Exception:
+        return False
+    return True
+
+
+def tar_pages(path):
+    with open(path, "rb") as raw:
+        with open_stream(raw) as tar:
+            return [member.name for member in tar
+                    if member.isfile() and is_image(member.name)]
+
+
+def pages(path, kind):
+    """Sorted page names of a volume, as its Archive class lists them.
+
+    Only the member directory is read; nothing is indexed or extracted.
+    """
+    if kind == "tree":
+        return sorted([entry.path for entry in os.scandir(path)
+                       if is_image(entry.name)])
+    elif kind == "zip":
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+    elif kind == "rar":
+        with rarfile.RarFile(path) as archive:
+            names = archive.namelist()
+    else:
+        names = tar_pages(path)
+    return sorted([name for name in names if is_image(name)])
+
+
+def open_volume(path, kind, pages=None, extract_rar=False,
+                rar_quota=2 * 1024 ** 3, tar_quota=2 * 1024 ** 3):
+    if kind == "tree":
+        return Tree(path, pages=pages)
+    elif kind == "zip":
+        return Zip(path, pages=pages)
+    elif kind == "tar":
+        return Tar(path, quota=tar_quota, pages=pages)
+    return Rar(path, extract=extract_rar, quota=rar_quota, pages=pages)
+
+
+class Catalog:
+    """SQLite catalog of every volume under a library directory.
+
+    Each row records the kind, page list, mtime and size of a file or
+    image directory. scan() only sniffs and lists files that are new
+    or whose mtime or size changed, so rescanning a large collection
+    costs about one stat per file. Files the reader cannot open are
+    kept with a NULL kind so they are not sniffed again. The catalog
+    shares its database with ProgressStore, so listings include the
+    reading progress of each volume. The mtime of every directory in a
+    scanned library is kept too, so opening a volume can tell whether
+    the library needs a rescan with one stat per directory.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(Paths.config_dir(), "progress.db")
+        self.con = sqlite3.connect(path, timeout=30)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        with self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS progress ("
+                             "volume TEXT PRIMARY KEY, page INTEGER)")
+            self.con.execute("CREATE TABLE IF NOT EXISTS volumes ("
+                             "path TEXT PRIMARY KEY, kind TEXT, "
+                             "mtime INTEGER, size INTEGER, pages TEXT, "
+                             "page_count INTEGER)")
+            self.con.execute("CREATE TABLE IF NOT EXISTS directories ("
+                             "path TEXT PRIMARY KEY, mtime INTEGER)")
+
+    def walk(self, root, mtimes=None):
+        """Yield (path, stat, tree pages) for every candidate volume.
+
+        Directories holding images are candidates with their pages
+        already listed; any other file that is not an image is one with
+        None for pages. The mtime of every directory visited is put in
+        mtimes, if given, before it is listed.
+        """
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            images = []
+            try:
+                if mtimes is not None:
+                    mtimes[directory] = os.stat(directory).st_mtime_ns
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        directories.append(entry.path)
+                    elif not entry.is_file():
+                        continue
+                    elif is_image(entry.name):
+                        images.append(entry.path)
+                    else:
+                        yield (entry.path, entry.stat(), None)
+                except OSError:
+                    continue
+            if images:
+                yield (directory, os.stat(directory), sorted(images))
+
+    def scan(self, root):
+        """Bring the catalog up to date with root.
+
+        Returns (volumes, changed): how many readable volumes there are
+        and how many had to be sniffed and listed again.
+        """
+        root = os.path.abspath(root)
+        os.stat(root)
+        prefix = os.path.join(root, "")
+        known = dict()
+        for (path, mtime, size) in self.con.execute(
+                "SELECT path, mtime, size FROM volumes "
+                "WHERE path = ? OR substr(path, 1, ?) = ?",
+                (root, len(prefix), prefix)):
+            known[path] = (mtime, size)
+        rows = []
+        seen = set()
+        mtimes = dict()
+        for (path, stat, tree_pages) in self.walk(root, mtimes):
+            seen.add(path)
+            size = 0 if tree_pages is not None else stat.st_size
+            if known.get(path) == (stat.st_mtime_ns, size):
+                continue
+            if tree_pages is not None:
+                (kind, names) = ("tree", tree_pages)
+            else:
+                try:
+                    kind = sniff(path)
+                    names = None if kind is None else pages(path, kind)
+                except Exception:
+                    # damaged archives are retried once they change
+                    (kind, names) = (None, None)
+            rows.append((path, kind, stat.st_mtime_ns, size,
+                         None if names is None else json.dumps(names),
+                         0 if names is None else len(names)))
+        with self.con:
+            self.con.executemany("INSERT OR REPLACE INTO volumes "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.con.executemany("DELETE FROM volumes WHERE path = ?",
+                                 [(path,) for path in known
+                                  if path not in seen])
+            self.con.execute("DELETE FROM directories "
+                             "WHERE path = ? OR substr(path, 1, ?) = ?",
+                             (root, len(prefix), prefix))
+            self.con.executemany("INSERT INTO directories VALUES (?, ?)",
+                                 mtimes.items())
+        (count,) = self.con.execute(
+            "SELECT COUNT(*) FROM volumes WHERE kind IS NOT NULL "
+            "AND (path = ? OR substr(path, 1, ?) = ?)",
+            (root, len(prefix), prefix)).fetchone()
+        return (count, len(rows))
+
+    def changed(self, root):
+        """Whether root was never scanned or a directory in it changed.
+
+        Adding, removing or renaming a volume changes the mtime of the
+        directory holding it, so this notices new volumes at any depth.
+        """
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, "")
+        rows = self.con.execute("SELECT path, mtime FROM directories "
+                                "WHERE path = ? OR substr(path, 1, ?) = ?",
+                                (root, len(prefix), prefix)).fetchall()
+        if len(rows) == 0:
+            return True
+        for (path, mtime) in rows:
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def get(self, path):
+        """(kind, pages) of a catalogued volume, or None.
+
+        Volumes that changed since the last scan are not returned.
+        """
+        path = os.path.abspath(path)
+        row = self.con.execute("SELECT kind, mtime, size, pages "
+                               "FROM volumes WHERE path = ?",
+                               (path,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        (kind, mtime, size, names) = row
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if (stat.st_mtime_ns, 0 if kind == "tree" else stat.st_size) != \
+                (mtime, size):
+            return None
+        return (kind, json.loads(names))
+
+    def volumes(self, root):
+        """(path, kind, page count, last read page) under root, by path."""
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, "")
+        return self.con.execute(
+            "SELECT path, kind, page_count, page FROM volumes "
+            "LEFT JOIN progress ON progress.volume = volumes.path "
+            "WHERE kind IS NOT NULL "
+            "AND (path = ? OR substr(path, 1, ?) = ?) ORDER BY path",
+            (root, len(prefix), prefix)).fetchall()
+
+    def close(self):
+        self.con.close()
+
+
+def scan_in_background(root):
+    """Rescan root in a daemon thread with a catalog of its own."""
+    def scan():
+        catalog = Catalog()
+        try:
+            catalog.scan(root)
+        except (OSError, sqlite3.Error):
+            pass
+        finally:
+            catalog.close()
+
+    thread = threading.Thread(target=scan, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+from multiprocessing import Lock, Pipe, Process, Queue, Value, cpu_count
+import textwrap
+
+from PIL import Image
+
+import EntryFormat
+import Preprocess
+import ResultCache
+import Trace
+
+special_chars = "{}[]!\"§$%&/()\n\\.,-~\' "
+tool = None
+# columns OCR'd at once; pools of OCR processes split the cores instead
+column_threads = cpu_count()
+
+
+def get_tool():
+    # pyocr probes for its backends on import; only workers pay for it
+    global tool
+    if tool is None:
+        import pyocr
+        tool = pyocr.get_available_tools()[0]
+    return tool
+
+
+def image_to_string(image, lang="jpn", builder=None):
+    return get_tool().image_to_string(image, lang=lang, builder=builder)
+
+
+def guess_mode(size):
+    mode = 5
+    if size[0] / size[1] < 1.15 and size[1] / size[0] < 1.15:
+        mode = 10
+    if size[0] > size[1] * 1.5:
+        mode = 7
+    return mode
+
+
+def ocr_block(image, mode, lang):
+    import pyocr.builders
+    with Trace.span("ocr.preprocess"):
+        (image, _) = Preprocess.prepare(image)
+    with Trace.span("tesseract", psm=mode):
+        string = image_to_string(image, lang=lang,
+                                 builder=pyocr.builders.TextBuilder(mode))
+    return "".join([c for c in string.strip() if c not in special_chars])
+
+
+def column_boxes(image, key, cache):
+    if cache is not None:
+        boxes = cache.get("columns", key)
+        if boxes is not None:
+            return json.loads(boxes)
+    with Trace.span("ocr.columns"):
+        boxes = Preprocess.column_boxes(image)
+    if cache is not None:
+        cache.put("columns", key, json.dumps(boxes))
+    return boxes
+
+
+def ocr(image, lang="jpn"):
+    mode = guess_mode(image.size)
+    cache = ResultCache.get_cache()
+    key = None
+    if cache is not None:
+        key = ResultCache.image_key(image, mode, lang,
+                                    Preprocess.version)
+        string = cache.get("ocr", key)
+        if string is not None:
+            return string
+    boxes = []
+    if mode == 5:
+        boxes = column_boxes(image, key, cache)
+    if len(boxes) > 1:
+        # tesseract runs as a subprocess, so threads are enough to OCR
+        # every column at once
+        columns = [image.crop(box) for box in boxes]
+        with ThreadPoolExecutor(min(len(columns), column_threads)) as pool:
+            string = "".join(pool.map(lambda column: ocr_block(column, 5,
+                                                               lang),
+                                      columns))
+    else:
+        string = ocr_block(image, mode, lang)
+    if cache is not None:
+        cache.put("ocr", key, string)
+    return string
+
+
+def wrap(string):
+    return textwrap.fill(string, 120, replace_whitespace=False,
+                         drop_whitespace=False)
+
+
+def not_found(string):
+    if string == "":
+        return "Nothing recognized"
+    return wrap(string)
+
+
+def entries(string):
+    """Yield the dictionary entries for string as they resolve.
+
+    Entries are the plain structures of myougiden_api.structure().
+    """
+    if string == "":
+        return
+    cache = ResultCache.get_cache()
+    if cache is not None:
+        found = cache.get("dictionary", string)
+        if found is not None:
+            yield from json.loads(found)
+            return
+    import myougiden_api
+    found = []
+    for entry in myougiden_api.entries(string):
+        found.append(entry)
+        yield entry
+    if cache is not None:
+        cache.put("dictionary", string,
+                  json.dumps(found, ensure_ascii=False))
+
+
+def lookup(string):
+    found = [EntryFormat.text(entry) for entry in entries(string)]
+    if len(found) == 0:
+        return not_found(string)
+    return "\n\n".join(found)
+
+
+def image_to_dict(image, draw=None):
+    string = ocr(image)
+    if draw is not None:
+        draw("Looking up " + string)
+    return lookup(string)
+
+
+def worker(requests, results, lock, latest):
+    def send(request_id, kind, payload):
+        with lock:
+            results.send((request_id, kind, payload))
+
+    # warm up while the reader draws its first page; if that fails, the
+    # same error comes back as the status of every request
+    try:
+        get_tool()
+        import myougiden_api  # noqa: F401
+    except Exception:
+        pass
+    while True:
+        request = requests.get()
+        if request is None:
+            cache = ResultCache.get_cache()
+            if cache is not None:
+                cache.close()
+            return
+        (request_id, kind, payload, trace) = request
+        if request_id != latest.value:
+            continue
+        Trace.enabled = Trace.keep = trace
+        try:
+            if kind == "text":
+                string = payload
+            else:
+                (mode, size, data) = payload
+                string = ocr(Image.frombytes(mode, size, data))
+            if request_id != latest.value:
+                continue
+            send(request_id, "status", "Looking up " + string)
+            found = 0
+            with Trace.span("dictionary"):
+                for entry in entries(string):
+                    if request_id != latest.value:
+                        break
+                    send(request_id, "entry", entry)
+                    found += 1
+            if found == 0 and request_id == latest.value:
+                send(request_id, "status", not_found(string))
+        except Exception as error:
+            send(request_id, "status", "Lookup failed: %s" % error)
+        # workers are killed rather than closed when the reader dies, so
+        # hit counts and access times must not wait for close()
+        cache = ResultCache.get_cache()
+        if cache is not None:
+            cache.flush()
+        if trace:
+            send(request_id, "trace", Trace.take())
+
+
+class LookupPool:
+    """Long-lived OCR and dictionary workers.
+
+    Workers keep their OCR tool and dictionary state warm between
+    selections. Only the cropped region is sent to them. Submitting a
+    new selection or calling cancel() makes the workers drop any older
+    request at the next stage boundary instead of killing them.
+
+    Results come back over a pipe as (request id, kind, payload)
+    messages: "status" replaces what is shown with a line of text,
+    "entry" adds a structured dictionary entry and "trace" carries the
+    worker's timing events when tracing is on. The read end's fileno()
+    can be watched by the event loop.
+    """
+
+    def __init__(self, workers=2):
+        self.requests = Queue()
+        (self.results, writer) = Pipe(duplex=False)
+        self.latest = Value("l", 0)
+        self.processes = []
+        lock = Lock()
+        for _ in range(max(1, workers)):
+            process = Process(target=worker,
+                              args=(self.requests, writer, lock,
+                                    self.latest),
+                              daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def fileno(self):
+        return self.results.fileno()
+
+    def drain(self):
+        messages = []
+        while self.results.poll():
+            messages.append(self.results.recv())
+        return messages
+
+    def cancel(self):
+        self.next_id()
+
+    def close(self):
+        """Ask the workers to exit and give them a moment to do so."""
+        self.cancel()
+        for _ in self.processes:
+            self.requests.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
+
+    def next_id(self):
+        with self.latest.get_lock():
+            self.latest.value += 1
+            return self.latest.value
+
+    def submit(self, image):
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        request_id = self.next_id()
+        self.requests.put((request_id, "image",
+                           (image.mode, image.size, image.tobytes()),
+                           Trace.enabled))
+        return request_id
+
+    def submit_text(self, string):
+        request_id = self.next_id()
+        self.requests.put((request_id, "text", string, Trace.enabled))
+        return request_id
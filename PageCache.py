@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import queue
+import threading
+
+from PIL import Image
+
+from Archive import MemoryFile
+import Trace
+
+
+def best_fit(width, height, image):
+    (x, y) = image.size
+    scale = width / x
+    if y * scale > height:
+        scale = height / y
+    new_x = int(x * scale)
+    new_y = int(y * scale)
+    if new_x <= 0:
+        new_x = 1
+    if new_y <= 0:
+        new_y = 1
+    return image.resize((new_x, new_y), Image.BILINEAR)
+
+
+# rotation steps (clockwise quarter turns) to lossless transposes
+transposes = {1: Image.ROTATE_270,
+              2: Image.ROTATE_180,
+              3: Image.ROTATE_90}
+
+
+def image_bytes(image):
+    (width, height) = image.size
+    return width * height * len(image.getbands())
+
+
+def unrotated_box(box, size, rotation):
+    """Map a box on a page shown rotated back onto the unrotated page.
+
+    size is the unrotated page size and rotation counts clockwise
+    quarter turns, as in transposes.
+    """
+    (x, y, x2, y2) = box
+    (width, height) = size
+    if rotation == 1:
+        return (y, height - x2, y2, height - x)
+    elif rotation == 2:
+        return (width - x2, height - y2, width - x, height - y)
+    elif rotation == 3:
+        return (width - y2, x, width - y, x2)
+    return box
+
+
+def fit_size(width, height, size):
+    (x, y) = size
+    scale = width / x
+    if y * scale > height:
+        scale = height / y
+    return (max(1, int(x * scale)), max(1, int(y * scale)))
+
+
+class PagePyramid:
+    """A decoded page and successively halved copies of it.
+
+    The base level may have been decoded at reduced scale (JPEG draft
+    mode), in which case it cannot serve sizes larger than itself and
+    the page has to be decoded again.
+    """
+
+    min_level = 256
+
+    def __init__(self, image, full_size):
+        self.full_size = full_size
+        self.levels = [image]
+        while min(image.size) >= 2 * self.min_level:
+            image = image.reduce(2)
+            self.levels.append(image)
+        self.nbytes = sum(image_bytes(level) for level in self.levels)
+
+    def trim(self, width, height):
+        """Drop the levels larger than width x height needs.
+
+        Showing the page larger afterwards decodes it again.
+        """
+        level = self.level_for(width, height)
+        while len(self.levels) > 1 and self.levels[0] is not level:
+            del self.levels[0]
+        self.nbytes = sum(image_bytes(level) for level in self.levels)
+
+    def level_for(self, width, height):
+        (target, _) = fit_size(width, height, self.full_size)
+        for level in reversed(self.levels):
+            if level.size[0] >= target:
+                return level
+        if self.levels[0].size == self.full_size:
+            return self.levels[0]
+        return None
+
+
+class PageCache:
+    """LRU cache of decoded, fitted pages bounded by a byte budget.
+
+    Keys are (page index, canvas size, rotation) tuples. The cache is
+    shared between the UI thread and the prefetch worker, so every
+    access goes through a lock.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.pages
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pages)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.size = 0
+
+    def resize(self, max_bytes):
+        """Change the budget, evicting what no longer fits."""
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.size > self.max_bytes:
+                (_, (_, evicted)) = self.pages.popitem(last=False)
+                self.size -= evicted
+
+    def get(self, key):
+        with self.lock:
+            entry = self.pages.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pages.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, image, nbytes=None):
+        if nbytes is None:
+            nbytes = image_bytes(image)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.pages.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.pages[key] = (image, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                (_, (_, evicted)) = self.pages.popitem(last=False)
+                self.size -= evicted
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "pages": len(self.pages),
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes}
+
+
+class PageLoader:
+    """Reads, decodes and fits pages of an archive.
+
+    Archives can be read from several threads at once, so the prefetch
+    threads and the UI read and decode pages in parallel. Decoded pages
+    are kept as pyramids so that a new canvas size is resampled from
+    the nearest larger level instead of the full page.
+
+    A pyramid larger than the budget is trimmed to the levels the
+    requested size needs. If it still does not fit and was decoded for
+    a tile, it is kept on its own as the large page, so it is not
+    decoded again for every tile, and the cache shrinks by its size so
+    the two stay within pyramid_bytes together, until release_large()
+    gives the cache its whole budget back. Other pyramids that do not
+    fit are not kept.
+    """
+
+    def __init__(self, images, image_files, pyramid_bytes=128 * 1024 * 1024):
+        self.images = images
+        self.image_files = image_files
+        self.pyramid_bytes = pyramid_bytes
+        self.pyramids = PageCache(pyramid_bytes)
+        self.large = (None, None)
+        self.lock = threading.Lock()
+
+    def read(self, index):
+        with Trace.span("archive.read", page=index):
+            return self.images.read(self.image_files[index])
+
+    def decode(self, index, width, height):
+        image = Image.open(MemoryFile(self.read(index)))
+        with Trace.span("decode", page=index):
+            full_size = image.size
+            # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale almost for free
+            image.draft(image.mode, fit_size(width, height, full_size))
+            if image.mode not in ("L", "RGB", "RGBA"):
+                image = image.convert("RGB")
+            image.load()
+        with Trace.span("pyramid", page=index):
+            return PagePyramid(image, full_size)
+
+    def pyramid(self, index):
+        pyramid = self.pyramids.get(index)
+        (large_index, large) = self.large
+        if pyramid is None and large_index == index:
+            pyramid = large
+        return pyramid
+
+    def release_large(self, keep=None):
+        """Drop the large page, unless it is page keep."""
+        with self.lock:
+            if self.large[0] is None or self.large[0] == keep:
+                return
+            self.large = (None, None)
+            self.pyramids.resize(self.pyramid_bytes)
+
+    def keep(self, index, pyramid, width, height, tiled):
+        if pyramid.nbytes > self.pyramid_bytes:
+            pyramid.trim(width, height)
+        with self.lock:
+            if pyramid.nbytes <= self.pyramids.max_bytes:
+                self.pyramids.put(index, pyramid, pyramid.nbytes)
+                return
+            if not tiled:
+                return
+            # the cache gets whatever the large page leaves, which may
+            # be nothing if the page alone is over budget
+            self.large = (index, pyramid)
+            self.pyramids.resize(max(0, self.pyramid_bytes -
+                                     pyramid.nbytes))
+
+    def level(self, index, width, height, tiled=False):
+        """The smallest decoded level of a page covering width x height."""
+        pyramid = self.pyramid(index)
+        level = None
+        if pyramid is not None:
+            level = pyramid.level_for(width, height)
+        if level is None:
+            pyramid = self.decode(index, width, height)
+            self.keep(index, pyramid, width, height, tiled)
+            level = pyramid.level_for(width, height)
+        return level
+
+    def page_size(self, index):
+        """Full size of a page; only its header is read if need be."""
+        pyramid = self.pyramid(index)
+        if pyramid is not None:
+            return pyramid.full_size
+        return Image.open(MemoryFile(self.read(index))).size
+
+    def load(self, index, size, rotation):
+        (width, height) = size
+        if rotation % 2 == 1:
+            (width, height) = (height, width)
+        level = self.level(index, width, height)
+        with Trace.span("best_fit", page=index):
+            image = best_fit(width, height, level)
+            if rotation != 0:
+                image = image.transpose(transposes[rotation])
+        return image
+
+    def tile(self, index, zoom, rotation, column, row, size=512):
+        """Render one tile of a page scaled by zoom.
+
+        Tiles are size pixels square, counted on the rotated page, and
+        smaller at its right and bottom edges. Only the part of the
+        nearest pyramid level under the tile is resampled.
+        """
+        (full_width, full_height) = self.page_size(index)
+        width = max(1, int(full_width * zoom))
+        height = max(1, int(full_height * zoom))
+        (shown_width, shown_height) = (width, height)
+        if rotation % 2 == 1:
+            (shown_width, shown_height) = (height, width)
+        box = (column * size, row * size,
+               min(shown_width, (column + 1) * size),
+               min(shown_height, (row + 1) * size))
+        box = unrotated_box(box, (width, height), rotation)
+        level = self.level(index, width, height, tiled=True)
+        scale = level.size[0] / width
+        with Trace.span("tile", page=index):
+            image = level.resize((box[2] - box[0], box[3] - box[1]),
+                                 Image.BILINEAR,
+                                 box=tuple(v * scale for v in box))
+            if rotation != 0:
+                image = image.transpose(transposes[rotation])
+        return image
+
+
+class Prefetcher:
+    """Decodes the pages around the current one in background threads.
+
+    Pages are handed out one at a time, nearest first, so each thread
+    reads and decodes a different page. Each call to schedule()
+    supersedes the previous one, so fast page turns never queue up work
+    for pages the reader has already left.
+    """
+
+    def __init__(self, loader, cache, distance=2, threads=2):
+        self.loader = loader
+        self.cache = cache
+        self.distance = distance
+        self.generation = 0
+        self.requests = queue.Queue()
+        self.threads = []
+        for _ in range(max(1, threads)):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def schedule(self, page, size, rotation):
+        if self.distance <= 0:
+            return
+        self.generation += 1
+        pages = []
+        for offset in range(1, self.distance + 1):
+            pages.append(page + offset)
+            pages.append(page - offset)
+        for p in pages:
+            if 0 <= p < len(self.loader.image_files):
+                self.requests.put((self.generation, p, size, rotation))
+
+    def stop(self):
+        for _ in self.threads:
+            self.requests.put(None)
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            (generation, page, size, rotation) = request
+            if generation != self.generation:
+                continue
+            key = (page, size, rotation)
+            if key in self.cache:
+                continue
+            try:
+                image = self.loader.load(page, size, rotation)
+            except Exception:
+                continue
+            self.cache.put(key, image)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+
+app_name = "ocr-manga"
+
+
+def cache_dir(*parts):
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+    path = os.path.join(base, app_name, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def config_dir(*parts):
+    base = os.environ.get("XDG_CONFIG_HOME",
+                          os.path.join(os.path.expanduser("~"), ".config"))
+    path = os.path.join(base, app_name, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_key(path):
+    """Hex digest naming a file at its current size and mtime."""
+    stat = os.stat(path)
+    key = "%s:%d:%d" % (os.path.abspath(path), stat.st_mtime_ns,
+                        stat.st_size)
+    return hashlib.sha1(key.encode()).hexdigest()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+from array import array
+import mmap
+import os
+import struct
+
+magic = b"OMPX"
+version = 1
+header = struct.Struct("=4sIII")
+
+
+def build(cur, path):
+    """Write the index of every kanji and kana headword in the database.
+
+    The file is a header followed by three uint32 arrays and a blob, in
+    native byte order since it is a local cache: key offsets into the
+    blob, id offsets into the id array, the entry ids themselves (most
+    frequent entries first), and the keys as UTF-8 sorted bytewise,
+    which is code point order.
+    """
+    words = dict()
+    cur.execute("SELECT kanji, ent_seq, frequent FROM kanjis "
+                "UNION ALL "
+                "SELECT reading, ent_seq, frequent FROM readings")
+    for (word, ent_seq, frequent) in cur.fetchall():
+        entries = words.setdefault(word.encode("utf-8"), dict())
+        entries[ent_seq] = entries.get(ent_seq, False) or bool(frequent)
+
+    keys = sorted(words)
+    key_offsets = array("I", [0])
+    id_offsets = array("I", [0])
+    ids = array("I")
+    max_length = 0
+    for key in keys:
+        key_offsets.append(key_offsets[-1] + len(key))
+        entries = words[key]
+        ids.extend(sorted(entries, key=lambda e: (not entries[e], e)))
+        id_offsets.append(len(ids))
+        max_length = max(max_length, len(key.decode("utf-8")))
+    for table in (key_offsets, id_offsets, ids):
+        if table.itemsize != 4:
+            raise RuntimeError("array('I') is not 32 bits here")
+
+    # several lookup workers may build it at once
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp, "wb") as index:
+        index.write(header.pack(magic, version, len(keys), max_length))
+        index.write(struct.pack("=I", len(ids)))
+        for table in (key_offsets, id_offsets, ids):
+            index.write(table.tobytes())
+        index.write(b"".join(keys))
+    os.replace(temp, path)
+
+
+class PrefixIndex:
+    """Memory-mapped sorted array of headwords for longest-match lookups.
+
+    Finding the longest word at a position narrows a binary search one
+    character at a time, so it costs a few dozen key comparisons no
+    matter how long the rest of the string is.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as index:
+            self.map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        (tag, file_version, self.count, self.max_length) = \
+            header.unpack_from(self.map, 0)
+        if tag != magic or file_version != version:
+            raise ValueError("%s is not a prefix index" % path)
+        (id_count,) = struct.unpack_from("=I", self.map, header.size)
+        start = header.size + 4
+        view = memoryview(self.map)
+        self.key_offsets = view[start:start + 4 * (self.count + 1)].cast("I")
+        start += 4 * (self.count + 1)
+        self.id_offsets = view[start:start + 4 * (self.count + 1)].cast("I")
+        start += 4 * (self.count + 1)
+        self.ids = view[start:start + 4 * id_count].cast("I")
+        self.blob = start + 4 * id_count
+
+    def key(self, i):
+        return self.map[self.blob + self.key_offsets[i]:
+                        self.blob + self.key_offsets[i + 1]]
+
+    def entries(self, i):
+        return list(self.ids[self.id_offsets[i]:self.id_offsets[i + 1]])
+
+    def narrow(self, prefix, lo, hi):
+        # first key >= prefix, then first key not starting with it
+        (a, b) = (lo, hi)
+        while a < b:
+            mid = (a + b) // 2
+            if self.key(mid) < prefix:
+                a = mid + 1
+            else:
+                b = mid
+        lo = a
+        b = hi
+        while a < b:
+            mid = (a + b) // 2
+            if self.key(mid)[:len(prefix)] == prefix:
+                a = mid + 1
+            else:
+                b = mid
+        return (lo, a)
+
+    def lookup(self, word):
+        """Entry ids of the headword exactly equal to word."""
+        key = word.encode("utf-8")
+        (lo, hi) = self.narrow(key, 0, self.count)
+        if lo < hi and self.key(lo) == key:
+            return self.entries(lo)
+        return []
+
+    def longest(self, text, start=0):
+        """Return (word, entry ids) for the longest headword at start.
+
+        Returns (None, []) when no headword starts there.
+        """
+        (lo, hi) = (0, self.count)
+        best = (None, [])
+        end = min(len(text), start + self.max_length)
+        for stop in range(start + 1, end + 1):
+            prefix = text[start:stop].encode("utf-8")
+            (lo, hi) = self.narrow(prefix, lo, hi)
+            if lo == hi:
+                break
+            if self.key(lo) == prefix:
+                best = (text[start:stop], self.entries(lo))
+        return best
+
+    def matches(self, text):
+        """Longest headword at every position of text.
+
+        Returns a list with one (word, entry ids) pair per character.
+        """
+        return [self.longest(text, i) for i in range(len(text))]
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import json
+from multiprocessing import Pool, cpu_count
+import os
+import sys
+import time
+
+from PIL import Image, ImageFilter
+
+from Archive import MemoryFile
+import Lookup
+from SearchIndex import SearchIndex
+
+# pages are analysed at 1/scale of their size when looking for text
+region_scale = 4
+images = None
+failure = None
+
+
+def index_path(path):
+    return os.path.normpath(path) + ".ocr"
+
+
+def load_index(path):
+    """Return {page name: record} for the pages already in the sidecar.
+
+    A record is {"size": [w, h], "regions": [{"box": [x, y, x2, y2],
+    "text": ...}, ...]} with boxes in unrotated page pixels. A partial
+    last line left by an interrupted pre-pass is ignored.
+    """
+    index = dict()
+    try:
+        sidecar = open(index_path(path), "r", encoding="utf-8")
+    except OSError:
+        return index
+    for line in sidecar:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        index[record["page"]] = record
+    sidecar.close()
+    return index
+
+
+def components(mask, width, height):
+    pixels = mask.load()
+    seen = bytearray(width * height)
+    boxes = []
+    for y in range(height):
+        for x in range(width):
+            if seen[y * width + x] or not pixels[x, y]:
+                continue
+            seen[y * width + x] = 1
+            stack = [(x, y)]
+            (x1, y1, x2, y2) = (x, y, x, y)
+            while stack:
+                (cx, cy) = stack.pop()
+                x1 = min(x1, cx)
+                y1 = min(y1, cy)
+                x2 = max(x2, cx)
+                y2 = max(y2, cy)
+                for (nx, ny) in ((cx + 1, cy), (cx - 1, cy),
+                                 (cx, cy + 1), (cx, cy - 1)):
+                    if nx < 0 or ny < 0 or nx >= width or ny >= height:
+                        continue
+                    if seen[ny * width + nx] or not pixels[nx, ny]:
+                        continue
+                    seen[ny * width + nx] = 1
+                    stack.append((nx, ny))
+            boxes.append((x1, y1, x2 + 1, y2 + 1))
+    return boxes
+
+
+def detect_regions(image):
+    """Find likely text blocks on a page.
+
+    Ink is smeared together at a reduced scale so that the glyphs of a
+    speech bubble merge into one blob. Blobs that are too large (artwork)
+    or too sparse or dense to be lettering are dropped.
+    """
+    (width, height) = image.size
+    small_size = (max(1, width // region_scale),
+                  max(1, height // region_scale))
+    small = image.convert("L").resize(small_size, Image.BOX)
+    ink = small.point(lambda p: 255 if p < 128 else 0)
+    mask = ink.filter(ImageFilter.MaxFilter(5))
+    regions = []
+    for (x, y, x2, y2) in components(mask, small_size[0], small_size[1]):
+        (w, h) = (x2 - x, y2 - y)
+        if w * h < 16:
+            continue
+        if w > small_size[0] / 3 or h > small_size[1] / 2:
+            continue
+        density = sum(ink.crop((x, y, x2, y2)).histogram()[255:]) / (w * h)
+        if density < 0.03 or density > 0.5:
+            continue
+        regions.append((x * region_scale, y * region_scale,
+                        min(width, x2 * region_scale),
+                        min(height, y2 * region_scale)))
+    return regions
+
+
+def init_worker(archive_class, path, threads):
+    global images, failure
+    # a pool whose initializer raises restarts its workers forever;
+    # ocr_page reports the failure instead
+    try:
+        images = archive_class(path)
+    except Exception as error:
+        images = None
+        failure = error
+    Lookup.column_threads = threads
+
+
+def ocr_page(filename):
+    if images is None:
+        raise RuntimeError("cannot open the volume: %s" % failure)
+    image = Image.open(MemoryFile(images.read(filename)))
+    image.load()
+    regions = []
+    for box in detect_regions(image):
+        try:
+            text = Lookup.ocr(image.crop(box))
+        except Exception:
+            continue
+        if text != "":
+            regions.append({"box": list(box), "text": text})
+    return {"page": filename, "size": list(image.size), "regions": regions}
+
+
+def run(archive, jobs=None):
+    """OCR every page of archive into its sidecar index.
+
+    Pages already present in the index are skipped, so an interrupted
+    pre-pass picks up where it stopped. Every page is added to the search
+    index as soon as it is recognized.
+    """
+    done = load_index(archive.path)
+    search_index = SearchIndex()
+    search_index.sync(archive.path, done)
+    pages = [p for p in archive.list() if p not in done]
+    total = len(done) + len(pages)
+    if len(pages) == 0:
+        print("All %d pages already indexed in %s"
+              % (total, index_path(archive.path)))
+        search_index.close()
+        return
+    if jobs is None:
+        jobs = cpu_count()
+    # build any index here once instead of in every worker
+    archive.load()
+    sidecar = open(index_path(archive.path), "a", encoding="utf-8")
+    start = time.time()
+    # every worker already runs Tesseract, so split the cores between
+    # their column threads rather than giving each worker all of them
+    pool = Pool(jobs, initializer=init_worker,
+                initargs=(type(archive), archive.path,
+                          max(1, cpu_count() // jobs)))
+    try:
+        for (count, record) in enumerate(pool.imap_unordered(ocr_page,
+                                                             pages), 1):
+            sidecar.write(json.dumps(record, ensure_ascii=False) + "\n")
+            sidecar.flush()
+            search_index.add(archive.path, record)
+            elapsed = time.time() - start
+            remaining = elapsed / count * (len(pages) - count)
+            sys.stdout.write("\r[%d/%d] %d regions in %s, %ds left   "
+                             % (len(done) + count, total,
+                                len(record["regions"]),
+                                os.path.basename(record["page"]),
+                                remaining))
+            sys.stdout.flush()
+        print()
+    except KeyboardInterrupt:
+        print("\nInterrupted; run --prepass again to resume.")
+        pool.terminate()
+    except RuntimeError as error:
+        print("\nError: %s" % error)
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+    sidecar.close()
+    search_index.close()
+
+
+def overlapping_text(record, box, threshold=0.5):
+    """Return the indexed text covered by box, or None.
+
+    box is in the same page coordinates as the record. A region counts
+    when at least threshold of it lies inside the selection. Regions are
+    joined in reading order: right to left, then top to bottom.
+    """
+    (bx, by, bx2, by2) = box
+    found = []
+    for region in record["regions"]:
+        (x, y, x2, y2) = region["box"]
+        overlap = (max(0, min(x2, bx2) - max(x, bx)) *
+                   max(0, min(y2, by2) - max(y, by)))
+        area = (x2 - x) * (y2 - y)
+        if area > 0 and overlap / area >= threshold:
+            found.append(region)
+    if len(found) == 0:
+        return None
+    found.sort(key=lambda r: (-r["box"][2], r["box"][1]))
+    return "".join(r["text"] for r in found)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+from PIL import Image
+
+# Tesseract is most accurate with glyphs of roughly this many pixels
+target_glyph = 40
+min_scale = 0.5
+max_scale = 4.0
+# used when the crop has too little ink to measure
+default_scale = 3.0
+# part of the OCR result cache key; bump whenever prepare() or
+# column_boxes() change what Tesseract is given
+version = 1
+np = None
+
+
+def load_numpy():
+    # numpy is only needed where OCR runs, not in the reader's UI
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def otsu_threshold(gray):
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = gray.size
+    levels = np.arange(256)
+    weight = np.cumsum(histogram)
+    mean = np.cumsum(histogram * levels)
+    background = weight[:-1]
+    foreground = total - background
+    valid = (background > 0) & (foreground > 0)
+    between = np.zeros(255)
+    mu_b = mean[:-1][valid] / background[valid]
+    mu_f = (mean[-1] - mean[:-1][valid]) / foreground[valid]
+    between[valid] = (background[valid] * foreground[valid] *
+                      (mu_b - mu_f) ** 2)
+    # a cleanly two-tone crop ties over the whole gap; take its middle
+    best = np.flatnonzero(between == between.max())
+    return int((best[0] + best[-1]) // 2)
+
+
+def ink_mask(gray, threshold):
+    ink = gray <= threshold
+    # lettering is the minority; white on black text gets inverted
+    if ink.mean() > 0.5:
+        ink = ~ink
+    return ink
+
+
+def runs(profile):
+    """Lengths of the runs of non-zero entries in a 1-d profile."""
+    inked = np.concatenate(([0], (profile > 0).astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(inked))
+    return edges[1::2] - edges[::2]
+
+
+def glyph_size(ink):
+    """Estimate the glyph size in pixels, or None.
+
+    Japanese glyphs are roughly square, so the width of the text
+    columns (vertical text) or the height of the text lines (horizontal
+    text) measures them. Whichever direction splits into more runs is
+    taken to be the one across the lines.
+    """
+    columns = runs(ink.sum(axis=0))
+    lines = runs(ink.sum(axis=1))
+    across = columns if len(columns) >= len(lines) else lines
+    across = across[across > 2]
+    if len(across) == 0:
+        return None
+    return float(np.median(across))
+
+
+def trim(ink, margin):
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if len(rows) == 0:
+        return None
+    (height, width) = ink.shape
+    return (max(0, cols[0] - margin), max(0, rows[0] - margin),
+            min(width, cols[-1] + 1 + margin),
+            min(height, rows[-1] + 1 + margin))
+
+
+def scale_for(glyph):
+    if glyph is None:
+        return default_scale
+    return min(max_scale, max(min_scale, target_glyph / glyph))
+
+
+def prepare(image):
+    """Turn a selection into what Tesseract reads best.
+
+    The crop is converted to grayscale, trimmed to its ink, scaled so
+    that glyphs reach target_glyph pixels and binarized to black text
+    on white. Returns the image and the scale that was applied.
+    """
+    load_numpy()
+    gray = np.asarray(image.convert("L"), dtype=np.uint8)
+    if gray.size == 0:
+        return (image.convert("L"), 1.0)
+    threshold = otsu_threshold(gray)
+    ink = ink_mask(gray, threshold)
+    scale = scale_for(glyph_size(ink))
+    box = trim(ink, max(2, int(target_glyph / 4 / scale)))
+    if box is None:
+        return (Image.fromarray(np.full(gray.shape, 255, np.uint8)), 1.0)
+    (x, y, x2, y2) = box
+    gray = gray[y:y2, x:x2]
+    ink = ink[y:y2, x:x2]
+    # light text on a dark background
+    if ink.any() and (~ink).any() and \
+            gray[ink].mean() > gray[~ink].mean():
+        gray = 255 - gray
+        threshold = 254 - threshold
+    # resample the grey levels, not the binary mask, for smooth edges
+    size = (max(1, int((x2 - x) * scale)), max(1, int((y2 - y) * scale)))
+    resized = np.asarray(Image.fromarray(gray).resize(size, Image.BICUBIC))
+    binary = np.where(resized <= threshold, 0, 255).astype(np.uint8)
+    return (Image.fromarray(binary), scale)
+
+
+def column_boxes(image):
+    """Split a vertical-text selection into its columns.
+
+    Columns are the inked runs of the horizontal projection profile.
+    Runs narrower than half a glyph (furigana, stray marks) are merged
+    into the closer neighbour. Boxes span the full height of the image
+    and are returned right to left, in reading order.
+    """
+    load_numpy()
+    gray = np.asarray(image.convert("L"), dtype=np.uint8)
+    if gray.size == 0:
+        return []
+    ink = ink_mask(gray, otsu_threshold(gray))
+    glyph = glyph_size(ink)
+    if glyph is None:
+        return []
+    inked = np.concatenate(([0], (ink.sum(axis=0) > 0).astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(inked))
+    spans = [[int(x), int(x2)] for (x, x2) in zip(edges[::2], edges[1::2])]
+    while len(spans) > 1:
+        widths = [x2 - x for (x, x2) in spans]
+        narrow = int(np.argmin(widths))
+        if widths[narrow] >= glyph / 2:
+            break
+        if narrow == 0:
+            neighbour = 1
+        elif narrow == len(spans) - 1:
+            neighbour = narrow - 1
+        elif (spans[narrow][0] - spans[narrow - 1][1] <=
+              spans[narrow + 1][0] - spans[narrow][1]):
+            neighbour = narrow - 1
+        else:
+            neighbour = narrow + 1
+        (first, second) = sorted((narrow, neighbour))
+        spans[first] = [spans[first][0], spans[second][1]]
+        del spans[second]
+    (height, width) = gray.shape
+    margin = max(1, int(glyph / 4))
+    return [(max(0, x - margin), 0, min(width, x2 + margin), height)
+            for (x, x2) in reversed(spans)]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sqlite3
+import threading
+
+import Paths
+
+
+class ProgressStore:
+    """Last read page of every volume, kept in SQLite.
+
+    set() only records the page in memory; a background thread commits
+    pending pages in one transaction once no new ones arrived for delay
+    seconds, so page turns and resize storms never touch the disk on
+    the UI thread. Each volume is one row keyed by its absolute path.
+    """
+
+    def __init__(self, path=None, delay=1.0):
+        if path is None:
+            path = os.path.join(Paths.config_dir(), "progress.db")
+        self.path = path
+        self.delay = delay
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closing = False
+        self.con = sqlite3.connect(path, timeout=30,
+                                   check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        with self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS progress ("
+                             "volume TEXT PRIMARY KEY, page INTEGER)")
+            (count,) = self.con.execute("SELECT COUNT(*) "
+                                        "FROM progress").fetchone()
+            if count == 0:
+                self.import_last_page()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def import_last_page(self, filename="last_page"):
+        # progress used to be kept as JSON in the working directory
+        try:
+            with open(filename, "r") as last_page:
+                pages = json.load(last_page)
+        except (OSError, ValueError):
+            return
+        self.con.executemany("INSERT OR REPLACE INTO progress VALUES (?, ?)",
+                             [(os.path.abspath(volume), page)
+                              for (volume, page) in pages.items()
+                              if isinstance(page, int)])
+
+    def get(self, volume, default=0):
+        volume = os.path.abspath(volume)
+        with self.lock:
+            if volume in self.pending:
+                return self.pending[volume]
+        with self.db_lock:
+            row = self.con.execute("SELECT page FROM progress "
+                                   "WHERE volume = ?", (volume,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set(self, volume, page):
+        with self.lock:
+            self.pending[os.path.abspath(volume)] = page
+        self.wake.set()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = dict()
+        if len(pending) == 0:
+            return
+        with self.db_lock:
+            try:
+                with self.con:
+                    self.con.executemany("INSERT OR REPLACE INTO progress "
+                                         "VALUES (?, ?)", pending.items())
+            except sqlite3.Error:
+                pass
+
+    def run(self):
+        while not self.closing:
+            self.wake.wait()
+            self.wake.clear()
+            # keep waiting while pages are still changing
+            while self.wake.wait(self.delay):
+                self.wake.clear()
+                if self.closing:
+                    break
+            self.flush()
+
+    def close(self):
+        self.closing = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        self.con.close()
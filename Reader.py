@@ -1,85 +1,111 @@
 #!/usr/bin/env python3
 
-import argparse
-import json
-from multiprocessing import Process, Queue
-import os
-import queue    # needed for multiprocessing.Queue singlas
-import textwrap
-import tkinter as tk
 import sys
 
-from PIL import Image, ImageTk
-import magic
-import myougiden_api
-import pyocr
-import pyocr.builders
-
-from Archive import Tree, Rar, Zip
-
-tool = pyocr.get_available_tools()[0]
-special_chars = "{}[]!\"§$%&/()\n\\.,-~\' "
-colors = {'0': '#ffffff',
-               '31': '#cd0000',
-               '32': '#00cd00',
-               '33': '#cdcd00',
-               '35': '#cd00cd',
-               '36': '#00cdcd'}
+import Startup
+# before the other imports, so that they are timed too
+if "--profile-startup" in sys.argv:
+    Startup.enable()
+
+import argparse  # noqa: E402
+from collections import OrderedDict  # noqa: E402
+import io  # noqa: E402
+import os  # noqa: E402
+import queue  # noqa: E402
+import tkinter as tk  # noqa: E402
+import tkinter.font as tkfont  # noqa: E402
+
+from PIL import Image, ImageTk  # noqa: E402
+
+import EntryFormat  # noqa: E402
+import Library  # noqa: E402
+from Lookup import LookupPool  # noqa: E402
+from PageCache import (PageCache, PageLoader, Prefetcher,  # noqa: E402
+                       best_fit, transposes)
+import Paths  # noqa: E402
+import Prepass  # noqa: E402
+from Progress import ProgressStore  # noqa: E402
+import ResultCache  # noqa: E402
+from SearchIndex import SearchIndex  # noqa: E402
+import Thumbnails  # noqa: E402
+import Trace  # noqa: E402
+
+# popup colors for the roles of EntryFormat runs
+colors = {'text': '#ffffff',
+          'match': '#cd0000',
+          'misc': '#00cd00',
+          'highlight': '#00cd00',
+          'subdue': '#cdcd00',
+          'reading': '#cd00cd',
+          'kanji': '#00cdcd'}
 
 
 class Application(tk.Frame):
 
-    def __init__(self, images, master=None):
+    # viewport mode
+    tile_size = 512
+    min_zoom = 0.05
+    max_zoom = 8.0
+
+    def __init__(self, images, master=None, cache_size=256, prefetch=2,
+                 lookups=None, progress=None, thumbnail_jobs=None):
         tk.Frame.__init__(self, master)
         self.images = images
         self.image_files = images.list()
-        if os.path.isfile("last_page"):
-            last_page = open("last_page", "r")
-            try:
-                self.last_page_json = json.load(last_page)
-                self.current_page = self.last_page_json[self.images.path]
-            except KeyError:
-                self.last_page_json[self.images.path] = 0
-                self.current_page = 0
-            except:
-                self.last_page_json = dict()
-                self.last_page_json[self.images.path] = 0
-                self.current_page = 0
-            last_page.close()
-        else:
-            self.last_page_json = dict()
-            self.last_page_json[self.images.path] = 0
-            self.current_page = 0
+        self.page_cache = PageCache(cache_size * 1024 * 1024 // 2)
+        self.page_loader = PageLoader(images, self.image_files,
+                                      cache_size * 1024 * 1024 // 2)
+        self.prefetcher = Prefetcher(self.page_loader, self.page_cache,
+                                     prefetch)
+        self.ocr_index = Prepass.load_index(images.path)
+        if progress is None:
+            progress = ProgressStore()
+        self.progress = progress
+        self.current_page = min(self.progress.get(images.path),
+                                max(0, len(self.image_files) - 1))
 
         self.pack(fill=tk.BOTH, expand=1)
         self.createWidgets()
         self.current_page_oid = 0
         self.current_page_image = None
-        self.current_page_file = None
         self.drawing_box = False
         self.box_oid = 0
         self.box_coords = (0, 0, 0, 0)
+        if lookups is None:
+            lookups = LookupPool()
+        self.lookups = lookups
         self.lookup = None
         self.tkimage = None
         self.rotation = 0
+        self.resize_job = None
         self.fullscreen = False
-        self.text = []
-        self.draw_queue = Queue()
-        self.after(100, self.check_queue)
+        self.hud = False
+        self.lookup_entries = []
+        self.lookup_status = False
+        self.viewport = False
+        self.zoom = None
+        self.view_x = 0
+        self.view_y = 0
+        self.tile_images = dict()
+        self.search_index = None
+        self.search_query = None
+        self.search_matches = dict()
+        self.overview = None
+        self.thumbnail_jobs = thumbnail_jobs
+        self.thumbnail_store = None
+        self.thumbnails = None
+        try:
+            # wake up as soon as a worker writes a result
+            self.tk.createfilehandler(self.lookups.fileno(), tk.READABLE,
+                                      self.check_queue)
+            self.polling = False
+        except (AttributeError, tk.TclError):
+            # no file handlers on this platform
+            self.polling = True
+            self.after(100, self.check_queue)
 
     def best_fit(self, width, height, image):
-        (x, y) = image.size
-        scale = width / x
-        if y * scale > height:
-            scale = height / y
-        # print(scale)
-        new_x = int(x * scale)
-        new_y = int(y * scale)
-        if new_x <= 0:
-            new_x = 1
-        if new_y <= 0:
-            new_y = 1
-        return image.resize((new_x, new_y), Image.BILINEAR)
+        return best_fit(width, height, image)
 
     def change_image(self, amount):
         self.kill_lookup()
@@ -88,37 +114,64 @@ class Application(tk.Frame):
             return
         self.clear_box()
         self.current_page = new_page
+        # a page held for the viewport is only needed while it is shown
+        self.page_loader.release_large(
+            keep=new_page if self.viewport else None)
         self.master.title("Yurumon reader (%d/%d)" % (new_page + 1,
                                                       len(self.image_files)))
-        if self.current_page_file is not None:
-            self.current_page_file.close()
-        self.current_page_file = self.images.open(self.image_files[new_page])
-        image = Image.open(self.current_page_file)
-        if self.rotation != 0:
-            image = image.rotate(-90 * self.rotation)
         (width, height) = (self.frame.winfo_width(), self.frame.winfo_height())
-        image = self.best_fit(width, height, image)
-        self.tkimage = ImageTk.PhotoImage(image)
-        self.frame.delete(self.current_page_oid)
-        self.current_page_oid = self.frame.create_image(int(width/2),
-                                                        int(height/2),
-                                                        image=self.tkimage)
+        if self.viewport:
+            if amount != 0:
+                (self.zoom, self.view_x, self.view_y) = (None, 0, 0)
+            with Trace.span("change_image", page=new_page):
+                self.draw_viewport()
+            if amount != 0:
+                self.progress.set(self.images.path, new_page)
+            self.draw_hud()
+            return
+        with Trace.span("change_image", page=new_page):
+            key = (new_page, (width, height), self.rotation)
+            image = self.page_cache.get(key)
+            if image is None:
+                image = self.page_loader.load(new_page, (width, height),
+                                              self.rotation)
+                self.page_cache.put(key, image)
+            self.prefetcher.schedule(new_page, (width, height),
+                                     self.rotation)
+            with Trace.span("photoimage"):
+                self.tkimage = ImageTk.PhotoImage(image)
+            self.frame.delete(self.current_page_oid)
+            self.current_page_oid = self.frame.create_image(
+                int(width/2), int(height/2), image=self.tkimage)
         self.current_page_image = image
-        last_page = open("last_page", "w")
-        self.last_page_json[self.images.path] = new_page
-        json.dump(self.last_page_json, last_page)
-        last_page.close()
-
-    def check_queue(self):
-        lookup = ""
-        try:
-            lookup = self.draw_queue.get(block=False)
-        except queue.Empty:
-            pass
-        if lookup != "":
+        self.draw_matches()
+        if amount != 0:
+            self.progress.set(self.images.path, new_page)
+        self.draw_hud()
+
+    def check_queue(self, *args):
+        changed = False
+        for (request_id, kind, payload) in self.lookups.drain():
+            if kind == "trace":
+                Trace.merge(payload)
+                self.draw_hud()
+                continue
+            if request_id != self.lookup:
+                continue
+            if kind == "status":
+                self.lookup_entries = [[("text", payload)]]
+                self.lookup_status = True
+            else:
+                if self.lookup_status:
+                    self.lookup_entries = []
+                    self.lookup_status = False
+                self.lookup_entries.append(EntryFormat.runs(payload))
+            changed = True
+        if changed:
             self.clear_box()
-            self.draw_dict(lookup)
-        self.after(100, self.check_queue)
+            self.draw_dict(self.lookup_entries)
+        if self.polling:
+            self.after(100, self.check_queue)
 
     def clear_box(self, event=None):
         self.drawing_box = False
@@ -147,9 +200,104 @@ class Application(tk.Frame):
         self.frame.bind('<Button-3>', self.side_tap)
         self.frame.bind('<Motion>', self.draw_box)
         self.frame.bind('<F11>', self.toggle_fullscreen)
-
-    def draw(self, string):
-        self.draw_queue.put(string)
+        self.frame.bind('<F3>', self.toggle_hud)
+        self.frame.bind('<g>', self.show_overview)
+        self.frame.bind('<z>', self.toggle_viewport)
+        self.frame.bind('<Control-f>', self.show_search)
+        self.frame.bind('<slash>', self.show_search)
+        self.frame.bind('<Up>', lambda e: self.pan(0, -100))
+        self.frame.bind('<Down>', lambda e: self.pan(0, 100))
+        self.frame.bind('<Prior>', lambda e: self.pan(
+            0, -self.frame.winfo_height() * 9 // 10))
+        self.frame.bind('<Next>', lambda e: self.pan(
+            0, self.frame.winfo_height() * 9 // 10))
+        self.frame.bind('<Button-4>', lambda e: self.pan(0, -100))
+        self.frame.bind('<Button-5>', lambda e: self.pan(0, 100))
+        self.frame.bind('<Shift-Button-4>', lambda e: self.pan(-100, 0))
+        self.frame.bind('<Shift-Button-5>', lambda e: self.pan(100, 0))
+        self.frame.bind('<MouseWheel>', lambda e: self.pan(
+            0, -100 if e.delta > 0 else 100))
+        self.frame.bind('<plus>', lambda e: self.zoom_by(1.25))
+        self.frame.bind('<equal>', lambda e: self.zoom_by(1.25))
+        self.frame.bind('<minus>', lambda e: self.zoom_by(0.8))
+        self.frame.bind('<Control-Button-4>', lambda e: self.zoom_by(
+            1.25, e.x, e.y))
+        self.frame.bind('<Control-Button-5>', lambda e: self.zoom_by(
+            0.8, e.x, e.y))
+        self.createPopup()
+        self.createSearch()
+
+    def createSearch(self):
+        self.search_box = tk.Entry(self.frame, width=30, font="14",
+                                   background="black", foreground="white",
+                                   insertbackground="white",
+                                   highlightthickness=1,
+                                   highlightcolor="#ffff00")
+        self.search_box.bind('<Return>', lambda e: self.search(1))
+        self.search_box.bind('<Shift-Return>', lambda e: self.search(-1))
+        self.search_box.bind('<Escape>', self.hide_search)
+
+    def createOverview(self):
+        self.overview = tk.Canvas(self, background="black",
+                                  highlightthickness=0, cursor="hand2",
+                                  yscrollincrement=40)
+        self.overview.bind('<Configure>', self.layout_overview)
+        self.overview.bind('<Button-1>', self.overview_click)
+        self.overview.bind('<g>', self.hide_overview)
+        self.overview.bind('<Escape>', self.hide_overview)
+        self.overview.bind('<Up>', lambda e: self.scroll_overview(-1))
+        self.overview.bind('<Down>', lambda e: self.scroll_overview(1))
+        self.overview.bind('<Prior>', lambda e: self.scroll_overview(-10))
+        self.overview.bind('<Next>', lambda e: self.scroll_overview(10))
+        self.overview.bind('<Button-4>', lambda e: self.scroll_overview(-3))
+        self.overview.bind('<Button-5>', lambda e: self.scroll_overview(3))
+        self.overview.bind('<MouseWheel>', lambda e: self.scroll_overview(
+            -3 if e.delta > 0 else 3))
+        self.overview_columns = 0
+        self.overview_drawn = set()
+        self.thumbnail_images = dict()
+
+    def createPopup(self):
+        # one Text widget holds the whole dictionary popup, with a tag
+        # per role, instead of a canvas item per colored segment
+        self.popup_font = tkfont.Font(font="14")
+        self.popup_layouts = OrderedDict()
+        self.popup = tk.Text(self.frame, font=self.popup_font, wrap=tk.NONE,
+                             background="black",
+                             foreground=colors['text'],
+                             borderwidth=0, highlightthickness=1,
+                             highlightbackground="white",
+                             highlightcolor="white", padx=1, pady=1,
+                             cursor="arrow", takefocus=0)
+        for (role, color) in colors.items():
+            self.popup.tag_configure(role, foreground=color)
+        self.popup.bind('<Button-1>', self.popup_click)
+
+    def close_thumbnails(self):
+        if self.thumbnails is not None:
+            self.thumbnails.stop()
+            self.thumbnails.join(1)
+        if self.thumbnail_store is not None and \
+                (self.thumbnails is None or not self.thumbnails.is_alive()):
+            self.thumbnail_store.close()
+
+    def draw_hud(self):
+        self.frame.delete("hud")
+        if not self.hud:
+            return
+        lines = ["%-14s %8.1f ms" % timing for timing in Trace.recent]
+        if len(lines) == 0:
+            lines = ["no timings yet"]
+        text = self.frame.create_text(self.frame.winfo_width() - 5, 5,
+                                      anchor=tk.NE, fill="#ffff00",
+                                      font="TkFixedFont",
+                                      text="\n".join(lines))
+        (x, y, x2, y2) = self.frame.bbox(text)
+        box = self.frame.create_rectangle(x - 3, y - 3, x2 + 3, y2 + 3,
+                                          fill="black", outline="#ffff00")
+        self.frame.addtag_withtag("hud", text)
+        self.frame.addtag_withtag("hud", box)
+        self.frame.tag_lower(box, text)
 
     def draw_box(self, event):
         if not self.drawing_box:
@@ -164,114 +312,275 @@ class Application(tk.Frame):
                                                    fill="#00AA00",
                                                    stipple="gray50")
 
-    def draw_dict(self, string):
-        words = self.parse_color_string(string)
-        self.text = []
-        margin = 5
-        xoff = 0
-        yoff = 0
-        for w in words:
-            (color, text) = w
-            if len(self.text) != 0:
-                (x, y, x2, y2) = self.frame.bbox(self.text[-1])
-                if text == "\n":
-                    (a, b, c, yoff) = self.frame.bbox("text")
-                    xoff = 0
-                    yoff -= 1
-                    text = ""
-                else:
-                    xoff = x2
-
-            self.text.append(self.frame.create_text(margin + xoff,
-                                                    margin + yoff, fill=color,
-                                                    anchor=tk.NW, text=text,
-                                                    font="14"))
-            self.frame.addtag_withtag("text", self.text[-1])
-        (x, y, x2, y2) = self.frame.bbox("text")
-        self.textbox = self.frame.create_rectangle(x - 1, y - 1,
-                                                   x2, y2, fill="black",
-                                                   outline="white")
-        self.frame.addtag_withtag("text", self.textbox)
-        self.frame.tag_lower(self.textbox, self.text[0])
-
-    def image_to_dict(self, image):
-        bid = self.box_oid
-        mode = 5
-        size = image.size
-        image = image.resize((size[0] * 3, size[1] * 3), Image.BICUBIC)
-        if size[0] / size[1] < 1.15 and size[1] / size[0] < 1.15:
-            mode = 10
-        if size[0] > size[1] * 1.5:
-            mode = 7
-        string = self.image_to_string(image, lang="jpn",
-                                      builder=pyocr.builders.TextBuilder(mode))
-        string = string_filtered = "".join([c for c in string.strip()
-                                            if c not in special_chars])
-        self.draw("Looking up " + string)
-        if string != "":
-            dict_entry = myougiden_api.run(string)
-        else:
-            dict_entry = None
-        # image.save("/tmp/export.png")
-        if dict_entry is not None and string != "":
-            string = dict_entry.strip("\n")
-        if string == "":
-            string = "Nothing recognized"
-        # print(string)
-        return textwrap.fill(string, 120, replace_whitespace=False,
-                             drop_whitespace=False)
-
-    def image_to_string(self, image, lang="jpn", builder=None):
-        return tool.image_to_string(image, lang=lang, builder=builder)
+    def draw_dict(self, blocks):
+        """Show blocks of (role, text) runs, a blank line apart."""
+        segments = []
+        width = 0
+        lines = 0
+        for runs in blocks:
+            (block, block_width, block_lines) = self.popup_layout(runs)
+            if len(block) == 0:
+                continue
+            if len(segments) > 0:
+                segments += ["\n\n", "text"]
+                lines += 1
+            segments += block
+            width = max(width, block_width)
+            lines += block_lines
+        if len(segments) == 0:
+            return
+        height = self.popup_font.metrics("linespace") * lines
+        self.popup.config(state=tk.NORMAL)
+        self.popup.delete("1.0", tk.END)
+        self.popup.insert(tk.END, *segments)
+        self.popup.config(state=tk.DISABLED)
+        margin = 4
+        border = int(self.popup.cget("highlightthickness"))
+        padding = int(self.popup.cget("padx"))
+        self.frame.create_window(margin, margin, anchor=tk.NW,
+                                 window=self.popup, tags="text",
+                                 width=width + 2 * (padding + border),
+                                 height=height + 2 * (padding + border))
+
+    def draw_viewport(self):
+        """Draw the visible tiles of the current page at self.zoom.
+
+        Tiles are rendered on demand and kept in the page cache. The
+        decoded page is trimmed to the levels the zoom needs and counted
+        against the pyramid budget, which it only exceeds when those
+        levels alone do. A zoom of None fits the page to the width of
+        the canvas.
+        """
+        (width, height) = (self.frame.winfo_width(), self.frame.winfo_height())
+        page = self.current_page
+        (page_width, page_height) = self.page_loader.page_size(page)
+        if self.rotation % 2 == 1:
+            (page_width, page_height) = (page_height, page_width)
+        if self.zoom is None:
+            self.zoom = width / page_width
+        shown_width = max(1, int(page_width * self.zoom))
+        shown_height = max(1, int(page_height * self.zoom))
+        self.view_x = max(0, min(self.view_x, shown_width - width))
+        self.view_y = max(0, min(self.view_y, shown_height - height))
+        # pages smaller than the canvas are centered
+        left = (width - shown_width) // 2 if shown_width < width \
+            else -self.view_x
+        top = (height - shown_height) // 2 if shown_height < height \
+            else -self.view_y
+        size = self.tile_size
+        columns = range(max(0, -left // size),
+                        min((shown_width + size - 1) // size,
+                            (width - left) // size + 1))
+        rows = range(max(0, -top // size),
+                     min((shown_height + size - 1) // size,
+                         (height - top) // size + 1))
+        self.frame.delete("tiles")
+        self.frame.delete(self.current_page_oid)
+        visible = dict()
+        for row in rows:
+            for column in columns:
+                key = (page, self.zoom, self.rotation, column, row)
+                photo = self.tile_images.get(key)
+                if photo is None:
+                    tile = self.page_cache.get(key)
+                    if tile is None:
+                        tile = self.page_loader.tile(page, self.zoom,
+                                                     self.rotation, column,
+                                                     row, size)
+                        self.page_cache.put(key, tile)
+                    photo = ImageTk.PhotoImage(tile)
+                visible[key] = photo
+                self.frame.create_image(left + column * size,
+                                        top + row * size, anchor=tk.NW,
+                                        image=photo, tags="tiles")
+        self.tile_images = visible
+        # stands in for the page image when mapping selections
+        self.current_page_oid = self.frame.create_rectangle(
+            left, top, left + shown_width, top + shown_height,
+            outline="", width=0, tags="tiles")
+        self.frame.tag_lower("tiles")
+        self.draw_matches()
+
+    def draw_matches(self):
+        """Outline the text regions of this page matching the search."""
+        self.frame.delete("matches")
+        matches = self.search_matches.get(self.current_page)
+        if not matches or self.rotation != 0:
+            return
+        bbox = self.frame.bbox(self.current_page_oid)
+        if bbox is None:
+            return
+        (ix, iy, ix2, iy2) = bbox
+        for ((width, height), (x, y, x2, y2)) in matches:
+            self.frame.create_rectangle(ix + x * (ix2 - ix) / width,
+                                        iy + y * (iy2 - iy) / height,
+                                        ix + x2 * (ix2 - ix) / width,
+                                        iy + y2 * (iy2 - iy) / height,
+                                        outline="#ffff00", width=2,
+                                        tags="matches")
+
+    def draw_thumbnails(self):
+        """Put the thumbnails of the visible cells of the grid in place.
+
+        JPEG thumbnails are only decoded once their cell scrolls into
+        view, so opening the grid costs the same for any volume size.
+        """
+        (cell_width, cell_height, left) = self.overview_cell
+        top = self.overview.canvasy(0)
+        bottom = self.overview.canvasy(self.overview.winfo_height())
+        first = int(top // cell_height) * self.overview_columns
+        last = int(bottom // cell_height + 1) * self.overview_columns
+        for index in range(first, min(last, len(self.image_files))):
+            if index in self.overview_drawn:
+                continue
+            image = self.thumbnail_images.get(index)
+            if image is None:
+                data = self.thumbnail_data.get(self.image_files[index])
+                if data is None:
+                    continue
+                image = ImageTk.PhotoImage(Image.open(io.BytesIO(data)))
+                self.thumbnail_images[index] = image
+            (row, column) = divmod(index, self.overview_columns)
+            self.overview.create_image(
+                left + column * cell_width + cell_width // 2,
+                row * cell_height + Thumbnails.size // 2 + 10,
+                image=image)
+            self.overview_drawn.add(index)
+
+    def hide_search(self, event=None):
+        self.frame.delete("search")
+        self.search_matches = dict()
+        self.search_query = None
+        self.frame.delete("matches")
+        self.frame.focus_set()
 
-    def kill_lookup(self):
-        if self.lookup is not None and self.lookup.is_alive():
+    def hide_overview(self, event=None, page=None):
+        self.overview.pack_forget()
+        self.frame.pack(fill=tk.BOTH, expand=1)
+        self.frame.focus_set()
+        self.update_idletasks()
+        if page is None:
+            page = self.current_page
+        self.change_image(page - self.current_page)
+
+    def layout_overview(self, event=None):
+        width = self.overview.winfo_width()
+        cell_width = Thumbnails.size + 20
+        cell_height = Thumbnails.size + 40
+        columns = max(1, width // cell_width)
+        left = (width - columns * cell_width) // 2
+        if (columns, left) != (self.overview_columns,
+                               self.overview_cell[2]):
+            self.overview_columns = columns
+            self.overview_cell = (cell_width, cell_height, left)
+            self.overview_drawn = set()
+            self.overview.delete("all")
+            for index in range(len(self.image_files)):
+                (row, column) = divmod(index, columns)
+                x = left + column * cell_width
+                y = row * cell_height
+                if index == self.current_page:
+                    self.overview.create_rectangle(
+                        x + 2, y + 2, x + cell_width - 2,
+                        y + cell_height - 2, outline="#ffff00")
+                self.overview.create_text(x + cell_width // 2,
+                                          y + Thumbnails.size + 25,
+                                          text=str(index + 1),
+                                          fill="white")
+            rows = (len(self.image_files) + columns - 1) // columns
+            self.overview.config(scrollregion=(0, 0, width,
+                                               rows * cell_height))
+        self.draw_thumbnails()
+
+    def load_thumbnails(self):
+        """Read cached thumbnails and start making the missing ones."""
+        self.thumbnail_store = Thumbnails.ThumbnailStore()
+        volume = Paths.file_key(self.images.path)
+        self.thumbnail_data = self.thumbnail_store.load(volume)
+        pages = dict((name, index)
+                     for (index, name) in enumerate(self.image_files))
+        missing = [name for name in self.image_files
+                   if name not in self.thumbnail_data]
+        if len(missing) == 0:
+            return
+        # pages around the current one first
+        missing.sort(key=lambda name: abs(pages[name] - self.current_page))
+        self.thumbnails = Thumbnails.ThumbnailGenerator(
+            self.images, missing, self.thumbnail_store, volume,
+            self.thumbnail_jobs)
+        self.thumbnails.start()
+        self.after(100, self.poll_thumbnails)
+
+    def overview_click(self, event):
+        (cell_width, cell_height, left) = self.overview_cell
+        column = int((self.overview.canvasx(event.x) - left) // cell_width)
+        row = int(self.overview.canvasy(event.y) // cell_height)
+        index = row * self.overview_columns + column
+        if 0 <= column < self.overview_columns and \
+                0 <= index < len(self.image_files):
+            self.hide_overview(page=index)
+
+    def pan(self, dx, dy):
+        if not self.viewport:
+            return
+        self.view_x += dx
+        self.view_y += dy
+        self.draw_viewport()
+
+    def poll_thumbnails(self):
+        added = False
+        while True:
             try:
-                self.lookup.terminate()
-            except:
-                pass
-        # self.frame.delete("selection")
+                (member, data) = self.thumbnails.results.get_nowait()
+            except queue.Empty:
+                break
+            self.thumbnail_data[member] = data
+            added = True
+        if added and self.overview.winfo_ismapped():
+            self.draw_thumbnails()
+        if self.thumbnails.is_alive() or not self.thumbnails.results.empty():
+            self.after(100, self.poll_thumbnails)
+
+    def popup_layout(self, runs):
+        """Return (Text.insert arguments, width, lines) for runs.
+
+        Text is measured a line at a time with the popup font, and the
+        result is kept so that showing the same entry again costs only
+        the insert.
+        """
+        key = tuple(runs)
+        layout = self.popup_layouts.get(key)
+        if layout is not None:
+            self.popup_layouts.move_to_end(key)
+            return layout
+        segments = []
+        for (role, text) in runs:
+            segments.append(text)
+            segments.append(role)
+        lines = "".join(text for (_, text) in runs).strip("\n").split("\n")
+        while len(segments) > 0 and segments[-2] == "\n":
+            del segments[-2:]
+        width = max(self.popup_font.measure(line) for line in lines)
+        layout = (tuple(segments), width, len(lines))
+        self.popup_layouts[key] = layout
+        if len(self.popup_layouts) > 64:
+            self.popup_layouts.popitem(last=False)
+        return layout
 
-    def lookup_entry(self, image, coords):
-        ocr_image = image.crop(coords)
-        string = self.image_to_dict(ocr_image)
-        if string is not None:
-            self.draw(string)
+    def kill_lookup(self):
+        if self.lookup is not None:
+            self.lookups.cancel()
+            self.lookup = None
+        # self.frame.delete("selection")
 
     def next_image(self, event):
         self.change_image(1)
 
-    def parse_color_string(self, string):
-        escape = "\x1b"
-        parts = string.split(escape)
-        color_tuples = []
-        new_parts = []
-        for part in parts:
-            if "\n" in part:
-                more_parts = part.split("\n")
-                for p in more_parts:
-                    if p != "":
-                        new_parts.append(p)
-                        new_parts.append("\n")
-            else:
-                new_parts.append(part)
-        parts = new_parts
-        for part in parts:
-            if part.startswith("["):
-                temp = part.split("m")
-                color = temp[0].strip("[")
-                text = "m".join(temp[1:])
-                if len(text) == 0:
-                    continue
-                try:
-                    color_tuples.append((colors[color], text))
-                except KeyError:
-                    color_tuples.append((colors["0"], text))
-            else:
-                if len(part) == 0:
-                    continue
-                color_tuples.append((colors["0"], part))
-        return color_tuples
+    def popup_click(self, event):
+        self.clear_box()
+        if self.box_oid != 0:
+            self.frame.delete(self.box_oid)
+        return "break"
 
     def prev_image(self, event):
         self.change_image(-1)
@@ -280,12 +589,93 @@ class Application(tk.Frame):
         self.frame.width = event.width    # >>>854
         self.frame.height = event.height  # >>>404
         self.frame.config(width=self.frame.width, height=self.frame.height)
-        self.update_screen()
+        # only render the last size of a window drag
+        if self.resize_job is not None:
+            self.after_cancel(self.resize_job)
+        self.resize_job = self.after(50, self.update_screen)
 
     def rotate(self, event):
         self.rotation = (self.rotation + 1) % 4
         self.update_screen()
 
+    def scroll_overview(self, amount):
+        self.overview.yview_scroll(amount, "units")
+        self.draw_thumbnails()
+
+    def search(self, direction):
+        """Jump to the next page, in direction, where the query is found.
+
+        A new query is looked up in the search index, which is filled
+        from the pre-pass sidecar the first time it is used.
+        """
+        query = "".join(self.search_box.get().split())
+        if query == "":
+            return "break"
+        if query != self.search_query:
+            if self.search_index is None:
+                self.search_index = SearchIndex()
+                self.search_index.sync(self.images.path, self.ocr_index)
+            pages = dict((name, index)
+                         for (index, name) in enumerate(self.image_files))
+            self.search_matches = dict()
+            for (_, page, size, box, text) in self.search_index.search(
+                    query, self.images.path):
+                if page in pages:
+                    self.search_matches.setdefault(pages[page], []).append(
+                        (size, box))
+            self.search_query = query
+            # the current page counts for a new query
+            start = self.current_page - direction
+        else:
+            start = self.current_page
+        found = sorted(self.search_matches)
+        if direction < 0:
+            found.reverse()
+        after = [page for page in found
+                 if (page - start) * direction > 0]
+        self.frame.delete("search_status")
+        if len(found) == 0:
+            status = "not found"
+        else:
+            target = (after or found)[0]
+            status = "%d/%d pages" % (sorted(self.search_matches).index(
+                target) + 1, len(found))
+            self.change_image(target - self.current_page)
+        self.frame.create_text(self.frame.winfo_width() - 8,
+                               self.frame.winfo_height() - 8,
+                               anchor=tk.SE, text=status, fill="#ffff00",
+                               tags=("search", "search_status"))
+        return "break"
+
+    def show_search(self, event=None):
+        self.frame.delete("search")
+        self.frame.create_window(4, self.frame.winfo_height() - 4,
+                                 anchor=tk.SW, window=self.search_box,
+                                 tags="search")
+        self.search_box.focus_set()
+        self.search_box.select_range(0, tk.END)
+        return "break"
+
+    def show_overview(self, event=None):
+        """Replace the page with a scrollable grid of every page."""
+        self.kill_lookup()
+        if self.overview is None:
+            self.createOverview()
+            self.overview_cell = (0, 0, -1)
+            self.load_thumbnails()
+        self.frame.pack_forget()
+        self.overview.pack(fill=tk.BOTH, expand=1)
+        self.overview.focus_set()
+        self.update_idletasks()
+        # the current page is marked, so redraw and scroll to it
+        self.overview_columns = 0
+        self.layout_overview()
+        rows = (len(self.image_files) + self.overview_columns - 1) // \
+            self.overview_columns
+        row = self.current_page // self.overview_columns
+        self.overview.yview_moveto(row / max(1, rows))
+        self.draw_thumbnails()
+
     def side_tap(self, event):
         if event.x < (self.frame.winfo_width() / 2):
             self.change_image(1)
@@ -329,20 +719,27 @@ class Application(tk.Frame):
             py2 = (by2 - iy) / (iy2 - iy)
             # print("%f, %f, %f, %f" % (px, py, px2, py2))
 
-            (width, height) = self.current_page_image.size
+            page_image = self.current_page_image
+            if self.viewport:
+                page_image = self.viewport_image()
+            (width, height) = page_image.size
             cx = int(px * width)
             cx2 = int(px2 * width)
             cy = int(py * height)
             cy2 = int(py2 * height)
             # print("%d, %d, %d, %d" % (cx, cy, cx2, cy2))
-            self.lookup = Process(target=self.lookup_entry,
-                                  args=(self.current_page_image,
-                                        (cx, cy, cx2, cy2)))
-            # draw = ImageDraw.Draw(self.current_page_image)
-            # draw.rectangle([cx, cy, cx2, cy2], outline="black")
-            # ocr_image = image
-            self.lookup.start()
-            # self.image_to_dict(ocr_image)
+            record = self.ocr_index.get(self.image_files[self.current_page])
+            if record is not None and self.rotation == 0:
+                (width, height) = record["size"]
+                string = Prepass.overlapping_text(record, (px * width,
+                                                           py * height,
+                                                           px2 * width,
+                                                           py2 * height))
+                if string is not None:
+                    self.lookup = self.lookups.submit_text(string)
+                    return
+            ocr_image = page_image.crop((cx, cy, cx2, cy2))
+            self.lookup = self.lookups.submit(ocr_image)
         except:
             pass
 
@@ -351,45 +748,188 @@ class Application(tk.Frame):
         self.master.attributes("-fullscreen", self.fullscreen)
         self.update_screen()
 
+    def toggle_viewport(self, event=None):
+        """Switch between fitting whole pages and a scroll/zoom view."""
+        self.viewport = not self.viewport
+        (self.zoom, self.view_x, self.view_y) = (None, 0, 0)
+        self.tile_images = dict()
+        self.frame.delete("tiles")
+        self.current_page_oid = 0
+        self.change_image(0)
+
+    def toggle_hud(self, event=None):
+        self.hud = not self.hud
+        Trace.enabled = self.hud or Trace.keep
+        self.draw_hud()
+
+    def viewport_image(self):
+        """The decoded page behind the viewport, as it is shown."""
+        (width, height) = self.page_loader.page_size(self.current_page)
+        image = self.page_loader.level(self.current_page,
+                                       max(1, int(width * self.zoom)),
+                                       max(1, int(height * self.zoom)))
+        if self.rotation != 0:
+            image = image.transpose(transposes[self.rotation])
+        return image
+
+    def zoom_by(self, factor, x=None, y=None):
+        """Zoom the viewport, keeping the point under x, y in place."""
+        if not self.viewport or self.zoom is None:
+            return
+        if x is None:
+            (x, y) = (self.frame.winfo_width() // 2,
+                      self.frame.winfo_height() // 2)
+        zoom = min(self.max_zoom, max(self.min_zoom, self.zoom * factor))
+        self.view_x = int((self.view_x + x) * zoom / self.zoom - x)
+        self.view_y = int((self.view_y + y) * zoom / self.zoom - y)
+        self.zoom = zoom
+        self.draw_viewport()
+
     def update_screen(self):
+        self.resize_job = None
         self.change_image(0)
 
 
 def main():
     parser = argparse.ArgumentParser(description="OCR Manga Reader")
-    parser.add_argument('mangafile', metavar='file', help="a .cbz/.zip, "
-                        ".cbr/.rar, .tar, or directory containing your manga")
-    args = parser.parse_args()
-    path = args.mangafile.lower()
+    parser.add_argument('mangafile', metavar='file', nargs='?',
+                        help="a .cbz/.zip, .cbr/.rar, .tar, or directory "
+                        "containing your manga")
+    parser.add_argument('--library', metavar='DIR', default=None,
+                        help="catalog every volume under DIR; without a "
+                        "file, list them with their progress")
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=256,
+                        help="memory budget for decoded pages (default: 256)")
+    parser.add_argument('--prefetch', metavar='N', type=int, default=2,
+                        help="pages to decode ahead and behind the current "
+                        "one (default: 2)")
+    parser.add_argument('--workers', metavar='N', type=int, default=2,
+                        help="number of OCR/dictionary lookup processes "
+                        "(default: 2)")
+    parser.add_argument('--prepass', action='store_true',
+                        help="OCR every page into an index next to the "
+                        "manga instead of opening the reader")
+    parser.add_argument('--jobs', metavar='N', type=int, default=None,
+                        help="processes used by --prepass (default: one "
+                        "per core) and for page thumbnails (default: half "
+                        "as many)")
+    parser.add_argument('--result-cache', metavar='MB', type=int,
+                        default=64,
+                        help="disk budget for cached OCR and dictionary "
+                        "results, 0 to disable (default: 64)")
+    parser.add_argument('--extract-rar', action='store_true',
+                        help="unpack rar volumes once in the background "
+                        "and read pages from the unpacked copy")
+    parser.add_argument('--rar-cache', metavar='MB', type=int, default=2048,
+                        help="disk quota for unpacked rar volumes "
+                        "(default: 2048)")
+    parser.add_argument('--tar-cache', metavar='MB', type=int, default=2048,
+                        help="disk quota for indexed and unpacked tar "
+                        "volumes (default: 2048)")
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help="record how long each stage takes and write "
+                        "it to FILE as Chrome trace-event JSON on exit")
+    parser.add_argument('--search', metavar='TEXT', default=None,
+                        help="print every page of the pre-OCR'd volumes "
+                        "(under --library DIR, if given) where TEXT "
+                        "appears")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print how long each import and startup step "
+                        "took once the first page is shown")
+    with Startup.step("parse arguments"):
+        args = parser.parse_args()
     filename = args.mangafile
-    
-    dir_check = os.path.isdir(filename)
-    if dir_check:
-        filetype = "Directory"
 
-    if not dir_check:
+    if args.search is not None:
+        search_index = SearchIndex()
+        root = None
+        if args.library is not None:
+            root = os.path.join(os.path.abspath(args.library), "")
+        for (volume, page, _, _, text) in search_index.search(args.search):
+            if root is None or volume.startswith(root):
+                print("%s: %s: %s" % (volume, page, text))
+        search_index.close()
+        return
+
+    record = None
+    rescan = False
+    if args.library is not None:
+        catalog = Library.Catalog()
+        if filename is None:
+            (count, changed) = catalog.scan(args.library)
+            print("%d volumes in %s, %d updated" % (count, args.library,
+                                                    changed))
+            for (volume, kind, pages, page) in catalog.volumes(args.library):
+                print("%5s/%-5d %s" % ("-" if page is None else page + 1,
+                                       pages, volume))
+            catalog.close()
+            return
+        with Startup.step("catalog lookup"):
+            record = catalog.get(filename)
+            # the rest of the library is brought up to date once the
+            # first page is shown
+            rescan = catalog.changed(args.library)
+        catalog.close()
+    elif filename is None:
+        parser.error("a file is required unless --library is given")
+
+    if record is not None:
+        # catalogued: no sniffing and no member listing
+        (kind, pages) = record
+        filename = os.path.abspath(filename)
+    else:
+        pages = None
         try:
-            filetype = str(magic.from_file(filename))
+            with Startup.step("file type"):
+                kind = Library.sniff(filename)
         except OSError:
             print("Error: file '%s' does not exist!" % filename)
             sys.exit()
-
-    if filetype == "Directory":
-        images = Tree(args.mangafile)
-    elif "Zip archive data" in filetype or "tar archive" in filetype:
-        images = Zip(args.mangafile)
-    elif "RAR archive data" in filetype:
-        images = Rar(args.mangafile)
-    else:
+    if kind is None:
         print("Error: Unsupported filetype for '%s'\n"
               "Please specify a valid .cbz/.zip, .cbr/.rar, .tar, or directory."
               % filename)
         sys.exit()
-
-    app = Application(images)
+    with Startup.step("open volume"):
+        images = Library.open_volume(filename, kind, pages,
+                                     extract_rar=args.extract_rar,
+                                     rar_quota=args.rar_cache * 1024 * 1024,
+                                     tar_quota=args.tar_cache * 1024 * 1024)
+
+    # set before any worker is forked so they all inherit it
+    ResultCache.enabled = args.result_cache > 0
+    ResultCache.max_bytes = args.result_cache * 1024 * 1024
+    Trace.enabled = Trace.keep = args.trace is not None
+
+    if args.prepass:
+        with images:
+            Prepass.run(images, args.jobs)
+        return
+
+    # start the workers before Tk so they are not forked from it; they
+    # load Tesseract and the dictionary while the first page is drawn
+    with Startup.step("start lookup workers"):
+        lookups = LookupPool(args.workers)
+    with Startup.step("Application"):
+        app = Application(images, cache_size=args.cache_size,
+                          prefetch=args.prefetch, lookups=lookups,
+                          thumbnail_jobs=args.jobs)
     app.master.title('OCR Manga Reader')
-    app.update_screen()
-    app.mainloop()
+    with Startup.step("first page"):
+        app.update_screen()
+        app.update_idletasks()
+    Startup.report()
+    if rescan:
+        Library.scan_in_background(args.library)
+    try:
+        app.mainloop()
+    finally:
+        app.progress.close()
+        app.close_thumbnails()
+        lookups.close()
+        images.close()
+        if args.trace is not None:
+            Trace.export(args.trace)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import sqlite3
+import time
+
+import Paths
+
+
+def image_key(image, mode, lang, version=0):
+    """Key of an OCR result; version tags the preprocessing used."""
+    digest = hashlib.sha1()
+    digest.update(("%s %dx%d " % ((image.mode,) + image.size)).encode())
+    digest.update(image.tobytes())
+    return "%s:%s:%s:%s" % (digest.hexdigest(), mode, lang, version)
+
+
+class ResultCache:
+    """On-disk cache of OCR text and dictionary output.
+
+    The "ocr" layer is keyed by a hash of the cropped pixels plus the
+    page segmentation mode, language and preprocessing version, the
+    "dictionary" layer (a JSON list of structured entries) by the
+    filtered query string. It is a single SQLite database in WAL mode,
+    so any number of lookup processes can share it; each process opens
+    its own connection. Entries are evicted least recently used first
+    once the stored values exceed max_bytes.
+
+    get() only reads. Access times older than touch_after seconds and
+    the hit and miss counts are kept in memory and written in one
+    transaction with the next put(), by flush() or every flush_every
+    lookups, so workers looking up cached results do not wait on each
+    other for the write lock. Lookup workers flush after every
+    request.
+    """
+
+    evict_every = 64
+    flush_every = 64
+    touch_after = 600
+
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024):
+        if path is None:
+            path = os.path.join(Paths.cache_dir(), "results.db")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.puts = 0
+        self.touched = dict()
+        self.counts = dict()
+        self.pending = 0
+        self.con = sqlite3.connect(path, timeout=30)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        with self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS entries ("
+                             "layer TEXT, key TEXT, value TEXT, "
+                             "size INTEGER, atime REAL, "
+                             "PRIMARY KEY (layer, key))")
+            self.con.execute("CREATE INDEX IF NOT EXISTS entries_atime "
+                             "ON entries (atime)")
+            self.con.execute("CREATE TABLE IF NOT EXISTS stats ("
+                             "layer TEXT PRIMARY KEY, hits INTEGER, "
+                             "misses INTEGER)")
+
+    def close(self):
+        try:
+            with self.con:
+                self.write_pending()
+        except sqlite3.Error:
+            pass
+        self.con.close()
+
+    def count(self, layer, hit):
+        counts = self.counts.setdefault(layer, [0, 0])
+        counts[0 if hit else 1] += 1
+        self.pending += 1
+
+    def write_pending(self):
+        self.con.executemany("UPDATE entries SET atime = ? "
+                             "WHERE layer = ? AND key = ?",
+                             [(atime, layer, key) for ((layer, key), atime)
+                              in self.touched.items()])
+        for (layer, (hits, misses)) in self.counts.items():
+            self.con.execute("INSERT OR IGNORE INTO stats VALUES (?, 0, 0)",
+                             (layer,))
+            self.con.execute("UPDATE stats SET hits = hits + ?, "
+                             "misses = misses + ? WHERE layer = ?",
+                             (hits, misses, layer))
+        self.touched = dict()
+        self.counts = dict()
+        self.pending = 0
+
+    def flush(self):
+        """Write the pending access times and hit counts."""
+        if self.pending == 0:
+            return
+        try:
+            with self.con:
+                self.write_pending()
+        except sqlite3.Error:
+            pass
+
+    def get(self, layer, key):
+        try:
+            row = self.con.execute("SELECT value, atime FROM entries "
+                                   "WHERE layer = ? AND key = ?",
+                                   (layer, key)).fetchone()
+        except sqlite3.Error:
+            return None
+        self.count(layer, row is not None)
+        if row is not None:
+            now = time.time()
+            if now - row[1] > self.touch_after:
+                self.touched[(layer, key)] = now
+        if self.pending >= self.flush_every:
+            self.flush()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, layer, key, value):
+        size = len(key) + len(value.encode("utf-8"))
+        try:
+            with self.con:
+                self.con.execute("INSERT OR REPLACE INTO entries "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (layer, key, value, size, time.time()))
+                self.touched.pop((layer, key), None)
+                self.write_pending()
+        except sqlite3.Error:
+            return
+        self.puts += 1
+        if self.puts % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        try:
+            with self.con:
+                (total,) = self.con.execute("SELECT COALESCE(SUM(size), 0) "
+                                            "FROM entries").fetchone()
+                rows = self.con.execute("SELECT rowid, size FROM entries "
+                                        "ORDER BY atime")
+                doomed = []
+                for (rowid, size) in rows:
+                    if total <= self.max_bytes:
+                        break
+                    doomed.append((rowid,))
+                    total -= size
+                self.con.executemany("DELETE FROM entries WHERE rowid = ?",
+                                     doomed)
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        self.flush()
+        stats = dict()
+        for (layer, hits, misses) in self.con.execute("SELECT * FROM stats"):
+            stats[layer] = {"hits": hits, "misses": misses}
+        (entries, size) = self.con.execute("SELECT COUNT(*), "
+                                           "COALESCE(SUM(size), 0) "
+                                           "FROM entries").fetchone()
+        stats["entries"] = entries
+        stats["bytes"] = size
+        stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+cache = None
+enabled = True
+max_bytes = 64 * 1024 * 1024
+
+
+def get_cache():
+    global cache
+    if not enabled:
+        return None
+    if cache is None:
+        try:
+            cache = ResultCache(max_bytes=max_bytes)
+        except (OSError, sqlite3.Error):
+            return None
+    return cache
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sqlite3
+
+import Paths
+
+
+def grams(text):
+    """Every character and character bigram of text."""
+    found = set(text)
+    found.update(text[i:i + 2] for i in range(len(text) - 1))
+    return found
+
+
+def query_grams(query):
+    # the bigrams alone cover every character of a longer query
+    if len(query) == 1:
+        return {query}
+    return set(query[i:i + 2] for i in range(len(query) - 1))
+
+
+class SearchIndex:
+    """Inverted n-gram index over the OCR'd text of every volume.
+
+    Each text region found by the pre-pass is a row; every character and
+    character bigram in it points at that row. A query looks up the rows
+    holding all of its bigrams and then checks them for the whole
+    string, so search time depends on how rare the query is rather than
+    on how much text is indexed. The index lives in the same database
+    as the library catalog and reading progress.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(Paths.config_dir(), "progress.db")
+        self.con = sqlite3.connect(path, timeout=30)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        with self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS ocr_regions ("
+                             "id INTEGER PRIMARY KEY, volume TEXT, "
+                             "page TEXT, region INTEGER, size TEXT, "
+                             "box TEXT, text TEXT, "
+                             "UNIQUE (volume, page, region))")
+            self.con.execute("CREATE TABLE IF NOT EXISTS ocr_grams ("
+                             "gram TEXT, region INTEGER, "
+                             "PRIMARY KEY (gram, region)) WITHOUT ROWID")
+            self.con.execute("CREATE INDEX IF NOT EXISTS ocr_grams_region "
+                             "ON ocr_grams (region)")
+
+    def add(self, volume, record):
+        """Index the regions of one pre-pass record, replacing old ones."""
+        with self.con:
+            self.insert(os.path.abspath(volume), record)
+
+    def insert(self, volume, record):
+        self.remove_page(volume, record["page"])
+        size = json.dumps(record["size"])
+        for (number, region) in enumerate(record["regions"]):
+            cursor = self.con.execute(
+                "INSERT INTO ocr_regions (volume, page, region, size, box, "
+                "text) VALUES (?, ?, ?, ?, ?, ?)",
+                (volume, record["page"], number, size,
+                 json.dumps(region["box"]), region["text"]))
+            self.con.executemany("INSERT OR IGNORE INTO ocr_grams "
+                                 "VALUES (?, ?)",
+                                 [(gram, cursor.lastrowid)
+                                  for gram in grams(region["text"])])
+
+    def remove_page(self, volume, page):
+        self.con.execute("DELETE FROM ocr_grams WHERE region IN "
+                         "(SELECT id FROM ocr_regions "
+                         "WHERE volume = ? AND page = ?)", (volume, page))
+        self.con.execute("DELETE FROM ocr_regions "
+                         "WHERE volume = ? AND page = ?", (volume, page))
+
+    def pages(self, volume):
+        return set(page for (page,) in self.con.execute(
+            "SELECT DISTINCT page FROM ocr_regions WHERE volume = ?",
+            (os.path.abspath(volume),)))
+
+    def sync(self, volume, records):
+        """Index the records of a sidecar that are not indexed yet.
+
+        Pages without any text have no rows, so they are indexed again
+        each time; that costs nothing since they add nothing.
+        """
+        done = self.pages(volume)
+        volume = os.path.abspath(volume)
+        with self.con:
+            for record in records.values():
+                if record["page"] not in done and record["regions"]:
+                    self.insert(volume, record)
+
+    def search(self, query, volume=None):
+        """Return (volume, page, page size, box, text) for every match.
+
+        With volume given, only that volume is searched. Rows are in
+        volume, page and region order.
+        """
+        query = "".join(query.split())
+        if query == "":
+            return []
+        wanted = sorted(query_grams(query))
+        marks = ",".join("?" * len(wanted))
+        sql = ("SELECT volume, page, size, box, text FROM ocr_regions "
+               "WHERE id IN (SELECT region FROM ocr_grams "
+               "WHERE gram IN (%s) GROUP BY region "
+               "HAVING COUNT(*) = ?)" % marks)
+        params = wanted + [len(wanted)]
+        if volume is not None:
+            sql += " AND volume = ?"
+            params.append(os.path.abspath(volume))
+        sql += " ORDER BY volume, page, region"
+        return [(found_volume, page, json.loads(size), json.loads(box), text)
+                for (found_volume, page, size, box, text)
+                in self.con.execute(sql, params) if query in text]
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import builtins
+import sys
+import threading
+import time
+
+enabled = False
+start = time.perf_counter()
+steps = []
+# how deep in nested imports each thread is
+local = threading.local()
+original_import = builtins.__import__
+
+
+def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level == 0 and name in sys.modules:
+        return original_import(name, globals, locals, fromlist, level)
+    begin = time.perf_counter()
+    local.depth = getattr(local, "depth", 0) + 1
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    finally:
+        local.depth -= 1
+        # nested imports are included in the outermost one
+        if local.depth == 0:
+            steps.append(("import " + name, time.perf_counter() - begin))
+
+
+def enable():
+    """Start recording, including the time every new import takes.
+
+    Reader imports this module first and calls enable() before its
+    other imports, so everything up to the first page shows up in
+    report().
+    """
+    global enabled
+    enabled = True
+    builtins.__import__ = timed_import
+
+
+class Step:
+    __slots__ = ("name", "begin")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            steps.append((self.name, time.perf_counter() - self.begin))
+        return False
+
+
+def step(name):
+    """Time an initialization step: with Startup.step("Tk"): ..."""
+    return Step(name)
+
+
+def report(out=sys.stderr):
+    """Print every recorded step and the time since start, once."""
+    global enabled
+    if not enabled:
+        return
+    enabled = False
+    builtins.__import__ = original_import
+    for (name, seconds) in steps:
+        out.write("%8.1f ms  %s\n" % (seconds * 1000, name))
+    out.write("%8.1f ms  total to first page\n"
+              % ((time.perf_counter() - start) * 1000))
+    out.flush()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import io
+import multiprocessing
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+import Paths
+
+# longest side of a thumbnail in pixels
+size = 160
+quality = 80
+images = None
+
+
+def init_worker(archive_class, path):
+    global images
+    # a pool whose initializer raises restarts its workers forever;
+    # make_thumbnail reports the failure instead
+    try:
+        images = archive_class(path)
+    except Exception:
+        images = None
+
+
+def make_thumbnail(filename):
+    """Return (filename, JPEG bytes), or (filename, None) on failure."""
+    try:
+        with images.open(filename) as page:
+            image = Image.open(page)
+            # let the JPEG decoder do most of the scaling
+            image.draft("RGB", (size, size))
+            image = image.convert("RGB")
+        image.thumbnail((size, size), Image.BILINEAR)
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=quality)
+        return (filename, out.getvalue())
+    except Exception:
+        return (filename, None)
+
+
+class ThumbnailStore:
+    """Thumbnails of every volume opened so far, kept in SQLite.
+
+    Thumbnails are keyed by the volume's Paths.file_key (its path, mtime
+    and size) and the member name, so a changed volume simply misses.
+    Whole volumes are evicted least recently opened first once the
+    stored thumbnails exceed max_bytes.
+    """
+
+    def __init__(self, path=None, max_bytes=256 * 1024 * 1024):
+        if path is None:
+            path = os.path.join(Paths.cache_dir(), "thumbnails.db")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, timeout=30,
+                                   check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        with self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS thumbnails ("
+                             "volume TEXT, member TEXT, data BLOB, "
+                             "PRIMARY KEY (volume, member))")
+            self.con.execute("CREATE TABLE IF NOT EXISTS volumes ("
+                             "volume TEXT PRIMARY KEY, used REAL, "
+                             "size INTEGER)")
+
+    def load(self, volume):
+        """Return {member: JPEG bytes} for every stored page of volume."""
+        with self.lock:
+            with self.con:
+                self.con.execute("UPDATE volumes SET used = ? "
+                                 "WHERE volume = ?", (time.time(), volume))
+            return dict(self.con.execute("SELECT member, data "
+                                         "FROM thumbnails WHERE volume = ?",
+                                         (volume,)))
+
+    def put(self, volume, thumbnails):
+        if len(thumbnails) == 0:
+            return
+        with self.lock:
+            with self.con:
+                self.con.executemany("INSERT OR REPLACE INTO thumbnails "
+                                     "VALUES (?, ?, ?)",
+                                     [(volume, member, data)
+                                      for (member, data) in thumbnails])
+                self.con.execute("INSERT OR IGNORE INTO volumes "
+                                 "VALUES (?, ?, 0)", (volume, time.time()))
+                # summed again so that replaced thumbnails are not
+                # counted twice
+                self.con.execute("UPDATE volumes SET used = ?, size = "
+                                 "(SELECT SUM(length(data)) FROM thumbnails "
+                                 "WHERE volume = ?) WHERE volume = ?",
+                                 (time.time(), volume, volume))
+
+    def evict(self, keep=None):
+        with self.lock:
+            rows = self.con.execute("SELECT volume, size FROM volumes "
+                                    "ORDER BY used").fetchall()
+            total = sum(size for (_, size) in rows)
+            with self.con:
+                for (volume, size) in rows:
+                    if total <= self.max_bytes:
+                        break
+                    if volume == keep:
+                        continue
+                    self.con.execute("DELETE FROM thumbnails "
+                                     "WHERE volume = ?", (volume,))
+                    self.con.execute("DELETE FROM volumes WHERE volume = ?",
+                                     (volume,))
+                    total -= size
+
+    def close(self):
+        self.con.close()
+
+
+class ThumbnailGenerator(threading.Thread):
+    """Makes the missing thumbnails of a volume in a process pool.
+
+    Finished thumbnails are saved to the store in small batches and put
+    on results as (member, JPEG bytes) for the UI to pick up.
+    """
+
+    batch = 16
+
+    def __init__(self, archive, pages, store, volume, jobs=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.archive = archive
+        self.pages = pages
+        self.store = store
+        self.volume = volume
+        self.jobs = jobs or max(1, multiprocessing.cpu_count() // 2)
+        self.results = queue.Queue()
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        # the reader has Tk running by now, so workers must not be
+        # forked from it
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn")
+        pool = context.Pool(min(self.jobs, len(self.pages)),
+                            initializer=init_worker,
+                            initargs=(type(self.archive), self.archive.path))
+        done = []
+        try:
+            for (member, data) in pool.imap_unordered(make_thumbnail,
+                                                      self.pages):
+                if self.stopped:
+                    break
+                if data is None:
+                    continue
+                self.results.put((member, data))
+                done.append((member, data))
+                if len(done) >= self.batch:
+                    self.store.put(self.volume, done)
+                    done = []
+            self.store.put(self.volume, done)
+            self.store.evict(keep=self.volume)
+        finally:
+            pool.terminate()
+            pool.join()
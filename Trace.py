@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+from collections import deque
+import json
+import os
+import threading
+import time
+
+# measure spans at all; checked first so disabled spans cost one lookup
+enabled = False
+# keep every event for export, not only the recent ones
+keep = False
+events = []
+recent = deque(maxlen=20)
+
+
+def now():
+    # CLOCK_MONOTONIC on Linux, so timestamps from the lookup worker
+    # processes line up with the reader's
+    return time.perf_counter_ns() // 1000
+
+
+class Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = now()
+        return self
+
+    def __exit__(self, *exc):
+        duration = now() - self.start
+        recent.append((self.name, duration / 1000))
+        if keep:
+            event = {"name": self.name, "ph": "X", "ts": self.start,
+                     "dur": duration, "pid": os.getpid(),
+                     "tid": threading.get_ident()}
+            if self.args:
+                event["args"] = self.args
+            events.append(event)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+null_span = NullSpan()
+
+
+def span(name, **args):
+    """Time a stage: with Trace.span("decode"): ..."""
+    if not enabled:
+        return null_span
+    return Span(name, args)
+
+
+def take():
+    """Return and forget the events recorded so far."""
+    global events
+    (taken, events) = (events, [])
+    return taken
+
+
+def merge(remote):
+    """Add events recorded in another process."""
+    for event in remote:
+        recent.append((event["name"], event["dur"] / 1000))
+    if keep:
+        events.extend(remote)
+
+
+def export(path):
+    """Write the kept events as Chrome trace-event JSON.
+
+    The file can be opened in chrome://tracing or Perfetto.
+    """
+    pids = set(event["pid"] for event in events)
+    metadata = [{"name": "process_name", "ph": "M", "pid": pid,
+                 "args": {"name": "reader" if pid == os.getpid()
+                          else "lookup worker %d" % pid}}
+                for pid in pids]
+    with open(path, "w") as trace:
+        json.dump({"traceEvents": metadata + events,
+                   "displayTimeUnit": "ms"}, trace)
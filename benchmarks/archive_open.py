@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Compare Zip.open() against the old read-and-copy implementation.
+
+Builds a synthetic CBZ, stored and deflated, and reports for each the
+bytes allocated and the time per page open, as JSON.
+"""
+
+import argparse
+from io import BytesIO
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from Archive import Zip  # noqa: E402
+
+
+def old_open(archive, filename):
+    imagefile = archive.directory().open(filename)
+    image = BytesIO()
+    image.write(imagefile.read())
+    image.seek(0)
+    return image
+
+
+def new_open(archive, filename):
+    return archive.open(filename)
+
+
+def make_volume(path, pages, page_size, compression):
+    with zipfile.ZipFile(path, "w", compression) as volume:
+        for page in range(pages):
+            # half random, half zeros so deflate has something to do
+            data = os.urandom(page_size // 2) + bytes(page_size // 2)
+            volume.writestr("%03d.jpg" % page, data)
+
+
+def measure(opener, archive, rounds):
+    names = archive.list()
+    # the caller reads the page once, like PIL does
+    tracemalloc.start()
+    for name in names:
+        opener(archive, name).read(16)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for name in names:
+            page = opener(archive, name)
+            page.read()
+            page.close()
+    elapsed = time.perf_counter() - start
+    return {"peak_bytes_allocated": peak,
+            "seconds_per_open": elapsed / (rounds * len(names))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=2 * 1024 * 1024,
+                        help="bytes per page (default: 2 MiB)")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {"pages": args.pages, "page_size": args.page_size}
+    with tempfile.TemporaryDirectory() as tmp:
+        for (label, compression) in (("stored", zipfile.ZIP_STORED),
+                                     ("deflated", zipfile.ZIP_DEFLATED)):
+            path = os.path.join(tmp, label + ".cbz")
+            make_volume(path, args.pages, args.page_size, compression)
+            archive = Zip(path)
+            results[label] = {
+                "before": measure(old_open, archive, args.rounds),
+                "after": measure(new_open, archive, args.rounds),
+            }
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Headless benchmark suite for OCR Manga Reader.
+
+Times archive listing and page access for every volume format, page
+decoding and fitting, popup entry layout, OCR of a fixture
+image and dictionary lookups. Results are written as JSON so runs can
+be compared between releases. Stages whose dependencies are missing
+(no display, no Tesseract, no dictionary database) are reported as
+skipped rather than failing the run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image  # noqa: E402
+
+from Archive import MemoryFile, Rar, Tar, Tree, Zip  # noqa: E402
+from PageCache import PageLoader, best_fit  # noqa: E402
+import volumes  # noqa: E402
+
+archive_classes = {"tree": Tree, "cbz-stored": Zip, "cbz-deflated": Zip,
+                   "tar": Tar, "tar-gz": Tar, "cbr": Rar}
+
+queries = ["日本", "食べる", "ありがとう", "大丈夫", "先生", "行かなきゃ",
+           "何だと", "魔法少女", "book", "taberu"]
+
+# a typical entry as myougiden_api.structure() returns it
+sample_entry = {"ent_seq": 1582710, "frequent": True,
+                "kanjis": [{"text": "日本", "info": None, "match": [0, 2]},
+                           {"text": "日本国", "info": None, "match": None}],
+                "readings": [{"text": "にほん", "info": None,
+                              "nokanji": False, "restrictions": [],
+                              "match": None},
+                             {"text": "にっぽん", "info": None,
+                              "nokanji": False, "restrictions": [],
+                              "match": None}],
+                "senses": [{"tags": "[n]",
+                            "glosses": [{"text": "Japan", "match": None}]},
+                           {"tags": "[adj-no]",
+                            "glosses": [{"text": "Japanese", "match": None},
+                                        {"text": "of Japan",
+                                         "match": None}]}]}
+
+
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"runs": repeat,
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.mean(times)}
+
+
+def bench_archives(volume_paths, repeat):
+    results = dict()
+    for (label, path) in volume_paths.items():
+        archive = archive_classes[label](path)
+        names = archive.list()
+
+        def read_all():
+            for name in names:
+                archive.read(name)
+
+        results[label] = {
+            "pages": len(names),
+            "list": timed(lambda: archive_classes[label](path).list(),
+                          repeat),
+            "open_per_page": scale(timed(read_all, repeat), len(names)),
+        }
+    return results
+
+
+def scale(result, count):
+    for key in ("min", "median", "mean"):
+        result[key] /= count
+    return result
+
+
+def bench_decode(tree, repeat, size):
+    archive = Tree(tree)
+    names = archive.list()
+    page = Image.open(MemoryFile(archive.read(names[0])))
+    page.load()
+
+    def decode():
+        image = Image.open(MemoryFile(archive.read(names[0])))
+        image.load()
+
+    def cold_load():
+        PageLoader(archive, names).load(0, size, 0)
+
+    loader = PageLoader(archive, names)
+    loader.load(0, size, 0)
+    return {"decode": timed(decode, repeat),
+            "best_fit": timed(lambda: best_fit(size[0], size[1], page),
+                              repeat),
+            "load_cold": timed(cold_load, repeat),
+            "load_from_pyramid": timed(lambda: loader.load(0, size, 0),
+                                       repeat)}
+
+
+def bench_popup(repeat, entries):
+    try:
+        import EntryFormat
+        import tkinter as tk
+        from Reader import Application
+        master = tk.Tk()
+        master.withdraw()
+    except Exception as e:
+        return {"skipped": str(e)}
+    app = Application.__new__(Application)
+    app.frame = tk.Canvas(master, width=1280, height=800)
+    app.createPopup()
+    blocks = [EntryFormat.runs(sample_entry) for _ in range(entries)]
+
+    def layout():
+        app.frame.delete("text")
+        app.draw_dict(blocks)
+        master.update_idletasks()
+
+    def cold_layout():
+        app.popup_layouts.clear()
+        layout()
+
+    result = {"entries": entries,
+              "entry_runs": timed(
+                  lambda: [EntryFormat.runs(sample_entry)
+                           for _ in range(entries)], repeat),
+              "draw_dict": timed(cold_layout, repeat),
+              "draw_dict_cached": timed(layout, repeat)}
+    master.destroy()
+    return result
+
+
+def bench_ocr(repeat, fixture):
+    try:
+        import Lookup
+        import ResultCache
+        Lookup.get_tool()
+    except Exception as e:
+        return {"skipped": str(e)}
+    ResultCache.enabled = False
+    image = Image.open(fixture)
+    image.load()
+    return {"fixture": os.path.basename(fixture),
+            "ocr": timed(lambda: Lookup.ocr(image), repeat),
+            "image_to_dict": timed(lambda: Lookup.image_to_dict(image),
+                                   repeat)}
+
+
+def bench_dictionary(repeat):
+    try:
+        import myougiden_api
+        engine = myougiden_api.LookupEngine()
+        engine.lookup(queries[0])
+    except BaseException as e:
+        return {"skipped": str(e)}
+
+    def cold():
+        engine.cache.clear()
+        for query in queries:
+            engine.lookup(query)
+
+    def warm():
+        for query in queries:
+            engine.lookup(query)
+
+    return {"queries": len(queries),
+            "run_per_query": scale(timed(
+                lambda: [myougiden_api.run(q) for q in queries], repeat),
+                len(queries)),
+            "engine_cold_per_query": scale(timed(cold, repeat),
+                                           len(queries)),
+            "engine_warm_per_query": scale(timed(warm, repeat),
+                                           len(queries))}
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=2400)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--canvas", default="1280x800",
+                        help="canvas size pages are fitted to")
+    parser.add_argument("--entries", type=int, default=20,
+                        help="dictionary entries in the popup benchmark")
+    parser.add_argument("--fixture", default=None,
+                        help="image to OCR (default: a generated page crop)")
+    parser.add_argument("--output", "-o", default=None,
+                        help="write JSON here instead of stdout")
+    args = parser.parse_args()
+    canvas = tuple(int(x) for x in args.canvas.split("x"))
+
+    results = {"revision": revision(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "parameters": vars(args)}
+    with tempfile.TemporaryDirectory() as tmp:
+        # tar indexes and extracted pages must not land in, or be
+        # warmed by, the user's real cache
+        os.environ["XDG_CACHE_HOME"] = os.path.join(tmp, "cache")
+        volume_paths = volumes.generate(tmp, args.pages, args.width,
+                                        args.height)
+        fixture = args.fixture
+        if fixture is None:
+            fixture = os.path.join(tmp, "fixture.png")
+            page = volumes.make_page(args.width, args.height, 0)
+            page.crop((0, 0, args.width // 4, args.height // 4)).save(fixture)
+        results["archive"] = bench_archives(volume_paths, args.repeat)
+        results["decode"] = bench_decode(volume_paths["tree"], args.repeat,
+                                         canvas)
+        results["popup"] = bench_popup(args.repeat, args.entries)
+        results["ocr"] = bench_ocr(args.repeat, fixture)
+        results["dictionary"] = bench_dictionary(args.repeat)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+    else:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
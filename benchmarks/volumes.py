@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Generate synthetic manga volumes for the benchmarks.
+
+Pages are noisy greyscale JPEGs with panel borders and blocks of
+vertical "text", which is enough to exercise decoding, resizing and
+archive access. Every format is written from the same pages.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tarfile
+import zipfile
+
+from PIL import Image, ImageDraw
+
+
+def make_page(width, height, seed):
+    rng = random.Random(seed)
+    noise = Image.effect_noise((width, height), 48).point(lambda p: p + 96)
+    draw = ImageDraw.Draw(noise)
+    # panels
+    for _ in range(4):
+        x = rng.randrange(0, width // 2)
+        y = rng.randrange(0, height // 2)
+        draw.rectangle((x, y, x + width // 2, y + height // 2),
+                       outline=0, width=max(2, width // 200))
+    # speech bubbles with columns of glyph-sized blocks
+    glyph = max(8, width // 40)
+    for _ in range(3):
+        x = rng.randrange(0, width - glyph * 6)
+        y = rng.randrange(0, height - glyph * 10)
+        draw.ellipse((x - glyph, y - glyph, x + glyph * 6, y + glyph * 10),
+                     fill=255, outline=0)
+        for column in range(4):
+            for row in range(rng.randrange(3, 8)):
+                gx = x + glyph * 4 - column * glyph * 1.3
+                gy = y + row * glyph * 1.1
+                draw.rectangle((gx, gy, gx + glyph * 0.8, gy + glyph * 0.8),
+                               fill=0)
+    return noise
+
+
+def write_pages(directory, pages, width, height):
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    for page in range(pages):
+        name = "%04d.jpg" % page
+        make_page(width, height, page).save(os.path.join(directory, name),
+                                            quality=85)
+        names.append(name)
+    return names
+
+
+def generate(output, pages=20, width=1600, height=2400):
+    """Write the volume in every available format, return {format: path}."""
+    volumes = dict()
+    tree = os.path.join(output, "tree")
+    names = write_pages(tree, pages, width, height)
+    volumes["tree"] = tree
+
+    for (label, compression) in (("cbz-stored", zipfile.ZIP_STORED),
+                                 ("cbz-deflated", zipfile.ZIP_DEFLATED)):
+        path = os.path.join(output, label + ".cbz")
+        with zipfile.ZipFile(path, "w", compression) as volume:
+            for name in names:
+                volume.write(os.path.join(tree, name), name)
+        volumes[label] = path
+
+    for (label, mode, extension) in (("tar", "w", ".tar"),
+                                     ("tar-gz", "w:gz", ".tar.gz")):
+        path = os.path.join(output, label + extension)
+        with tarfile.open(path, mode) as volume:
+            for name in names:
+                volume.add(os.path.join(tree, name), name)
+        volumes[label] = path
+
+    if shutil.which("rar") is not None:
+        path = os.path.join(output, "cbr.cbr")
+        subprocess.run(["rar", "a", "-ep", "-m0", "-idq", path] +
+                       [os.path.join(tree, name) for name in names],
+                       check=True)
+        volumes["cbr"] = path
+    return volumes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output", help="directory to write the volumes to")
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=2400)
+    args = parser.parse_args()
+    for (label, path) in generate(args.output, args.pages, args.width,
+                                  args.height).items():
+        print("%s\t%s" % (label, path))
+
+
+if __name__ == "__main__":
+    main()
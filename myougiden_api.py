@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 
-import argparse
+from collections import OrderedDict
+import os
 import re
 import sys
 
 import romkan
 
 from myougiden import (
-    color,
     common,
     config,
     database,
@@ -16,151 +16,11 @@ from myougiden import (
     texttools as tt
 )
 
+import EntryFormat
+import Paths
+import PrefixIndex
 
-def run(query):
-    ap = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
-
-    ap.add_argument('--version', action='store_true',
-                    help='Show version.')
-
-    ag = ap.add_argument_group('Type of query',
-                               '''What field to look in.  If not provided,
-                                  try all of them and return the first
-                                  to match.''')
-    ag.add_argument('-k', '--kanji', action='store_const', dest='field',
-                    const='kanji', default='auto',
-                    help='''Return entries matching query on kanji.''')
-
-    ag.add_argument('-r', '--reading', action='store_const', dest='field',
-                    const='reading',
-                    help='''Return entries matching query on reading
-                            (in kana or rōmaji).''')
-
-    ag.add_argument('-g', '--gloss', '--meaning', action='store_const',
-                    dest='field', const='gloss',
-                    help='''Return entries matching query on glosses (English
-                            translations/meaning).''')
-
-    ag = ap.add_argument_group('Query options')
-    ag.add_argument('--case-sensitive', '--sensitive', action='store_true',
-                    help='''Case-sensitive search (distinguish uppercase from
-                            lowercase). Default: Insensitive, unless there's an
-                            uppercase letter in query.''')
-
-    ag.add_argument('-x', '--regexp', action='store_true',
-                    help='''Regular expression search.  Extent limits (-e) are
-                            respected.  Regexps currently don't work
-                            for rōmaji; use kana for readings.''')
-
-    ag.add_argument('-e', '--extent', default='auto',
-                    choices=('whole', 'beginning', 'word', 'partial', 'auto'),
-                    help='''How much of the field should the query match:
-                            - whole: Query must match the entire field.
-                            - beginning: Query must match the beginning
-                                         of the field.
-                            - word: Query must match whole word (at present
-                                    only works for English; treated as 'whole'
-                                    for kanji or reading fields.)
-                            - partial: Query may match anywhere, even partially
-                                       inside words.
-                            - auto (default): Try all four, and return the
-                                              first to match something.''')
-
-    ag.add_argument('-w', '--whole', action='store_const',
-                    const='whole', dest='extent',
-                    help='''Equivalent to --extent=whole.''')
-
-    ag.add_argument('-b', '--beginning', action='store_const',
-                    const='beginning', dest='extent',
-                    help='''Equivalent to --extent=beginning.''')
-
-    ag.add_argument('--word', action='store_const', const='word',
-                    dest='extent',
-                    help='''Equivalent to --extent=word.''')
-
-    ag.add_argument('-p', '--partial', action='store_const',
-                    const='partial', dest='extent',
-                    help='Equivalent to --extent=partial.')
-    ag.add_argument('-f', '--frequent', '-P', action='store_true',
-                    help='''Restrict to frequent words (equivalent
-                            to EDICT entries marked as ‘(P)’)''')
-
-    ag = ap.add_argument_group('Output control')
-    ag.add_argument('--output-mode', default='tab',
-                    choices=('human', 'tab', 'auto'),
-                    help='''Output mode; one of:
-                            - human: Multiline human-readable output.
-                            - tab: One-line tab-separated.
-                            - auto (default): Human if output is to
-                                              terminal, tab if writing
-                                              to pipe or file.''')
-
-    ag.add_argument('-t', '--tsv', '--tab', action='store_const',
-                    const='tab', dest='output_mode',
-                    help="Equivalent to --output-mode=tab")
-
-    ag.add_argument('--human', action='store_const', const='human',
-                    dest='output_mode',
-                    help="Equivalent to --output-mode=human")
-    ag.add_argument('--color', choices=('yes', 'no', 'auto'), default='no',
-                    help='''Whether to colorize output.  Default 'auto' means to
-                            colorize if writing to a terminal.''')
-    ag.add_argument('-c', action='store_const', const='yes', dest='color',
-                    help='Equivalent to --color=yes')
-    ag.add_argument('--background', '--bg', choices=('dark', 'light', 'auto'),
-                    default='auto',
-                    help='''Use colorscheme for dark or light background.
-                            Autodetection can be spotty.  If it's not working
-                            for you, you can also set it in the BACKGROUND
-                            environment variable.''')
-
-    ag.add_argument('--out-hepburn', '--oh',
-                    action='store_const', const=romkan.to_hepburn,
-                    dest='out_romaji', default=None,
-                    help='Convert reading to Hepburn rōmaji in output.')
-    ag.add_argument('--out-kunrei', '--ok',
-                    action='store_const', const=romkan.to_kunrei,
-                    dest='out_romaji', default=None,
-                    help='Convert reading to Kunrei rōmaji in output.')
-
-    ag = ap.add_argument_group('Abbreviations help')
-    ag.add_argument('--list-abbrevs', action='store_true',
-                    help='''List all abbreviations.''')
-    ag.add_argument('-a', '--abbrev', metavar='ABBREV', default=None,
-                    help='''Print meaning of an abbreviation.''')
-
-    ap.add_argument('query', help='Text to look for.',
-                    metavar='QUERY', nargs='*')
-
-    args = ap.parse_args()
-    args.output_mode = 'human'
-    if len(query) == 0:
-        return None
-    args.query = [query]
-    args.color = 'yes'
-    args.background = 'dark'
-
-    color.use_color = True
-    args.query = ' '.join(args.query)
-
-    # case sensitivity must be handled before opening db
-    if not args.case_sensitive:
-        if re.search("[A-Z]", args.query):
-            args.case_sensitive = True
-
-    if not config:
-        print('%s: Could not find config.ini!' % fmt('ERROR', 'error'))
-
-        # print version regardless
-        if args.version:
-            print(common.version(None))
-        sys.exit(2)
-
-    # try to open database
-    try:
-        con, cur = database.opendb(case_sensitive=args.case_sensitive)
-    except database.DatabaseAccessError as e:
-        print('''Database error: %s.
+database_help = '''Database error: %s.
     Expected database version %s at:
     %s
 
@@ -174,152 +34,428 @@ def run(query):
     JMdict is frequently updated.  If you'd like to keep up with new entries,
     you might want to add the update command to cron (for example, in
     /etc/cron.weekly/myougiden ).'''
-              % (str(e), config.get('core', 'dbversion'),
-                 config.get('paths', 'database')))
-
-        if args.version:
-            print()
-            print(common.version(None))
-        sys.exit(2)
-
-    # handle short commands first.
-    if args.version:
-        print(common.version(cur))
-        sys.exit(0)
 
-    elif args.list_abbrevs:
-        print(orm.abbrevs_table(cur))
-        sys.exit(0)
 
-    elif args.abbrev:
-        a = orm.abbrev_line(cur, args.abbrev)
-        if a:
-            print(a)
-            sys.exit(0)
+def fetch_entries(cur, ent_seqs, chunk=500):
+    """Fetch many entries with a fixed number of queries.
+
+    Builds the same orm objects as orm.fetch_entry, which needs several
+    queries per entry and per sense. Returns {ent_seq: orm.Entry}.
+    """
+    ent_seqs = list(set(ent_seqs))
+    entries = dict()
+    # stay below SQLite's limit on bound parameters
+    for start in range(0, len(ent_seqs), chunk):
+        entries.update(fetch_chunk(cur, ent_seqs[start:start + chunk]))
+    return entries
+
+
+def fetch_chunk(cur, ent_seqs):
+    marks = ','.join('?' * len(ent_seqs))
+    kanjis = dict((ent_seq, []) for ent_seq in ent_seqs)
+    readings = dict((ent_seq, []) for ent_seq in ent_seqs)
+    senses = dict((ent_seq, []) for ent_seq in ent_seqs)
+
+    cur.execute('SELECT ent_seq, kanji_id, kanji, ke_inf, frequent '
+                'FROM kanjis WHERE ent_seq IN (%s) ORDER BY rowid;' % marks,
+                ent_seqs)
+    for row in cur.fetchall():
+        kanjis[row[0]].append(orm.Kanji(kanji_id=row[1], text=row[2],
+                                        ke_inf=row[3], frequent=row[4]))
+
+    by_reading = dict()
+    cur.execute('SELECT ent_seq, reading_id, reading, re_nokanji, frequent, '
+                're_inf FROM readings WHERE ent_seq IN (%s) ORDER BY rowid;'
+                % marks, ent_seqs)
+    for row in cur.fetchall():
+        reading = orm.Reading(reading_id=row[1], text=row[2],
+                              re_nokanji=row[3], frequent=row[4],
+                              re_inf=row[5])
+        readings[row[0]].append(reading)
+        by_reading[reading.reading_id] = reading
+    cur.execute('SELECT reading_id, re_restr FROM reading_restrictions '
+                'WHERE reading_id IN (SELECT reading_id FROM readings '
+                'WHERE ent_seq IN (%s)) ORDER BY rowid;' % marks, ent_seqs)
+    for (reading_id, re_restr) in cur.fetchall():
+        by_reading[reading_id].re_restr.append(re_restr)
+
+    by_sense = dict()
+    cur.execute('SELECT ent_seq, sense_id, pos, field, misc, dial, s_inf '
+                'FROM senses WHERE ent_seq IN (%s) ORDER BY rowid;' % marks,
+                ent_seqs)
+    for row in cur.fetchall():
+        sense = orm.Sense(sense_id=row[1], pos=row[2], field=row[3],
+                          misc=row[4], dial=row[5], s_inf=row[6])
+        senses[row[0]].append(sense)
+        by_sense[sense.sense_id] = sense
+    sense_ids = ('SELECT sense_id FROM senses WHERE ent_seq IN (%s)'
+                 % marks)
+    for (table, column, attribute) in (
+            ('sense_kanji_restrictions', 'stagk', 'stagk'),
+            ('sense_reading_restrictions', 'stagr', 'stagr'),
+            ('glosses', 'gloss', 'glosses')):
+        cur.execute('SELECT sense_id, %s FROM %s WHERE sense_id IN (%s) '
+                    'ORDER BY rowid;' % (column, table, sense_ids),
+                    ent_seqs)
+        for (sense_id, value) in cur.fetchall():
+            getattr(by_sense[sense_id], attribute).append(value)
+
+    entries = dict()
+    cur.execute('SELECT ent_seq, frequent FROM entries '
+                'WHERE ent_seq IN (%s);' % marks, ent_seqs)
+    for (ent_seq, frequent) in cur.fetchall():
+        entries[ent_seq] = orm.Entry(ent_seq=ent_seq, frequent=frequent,
+                                     kanjis=kanjis[ent_seq],
+                                     readings=readings[ent_seq],
+                                     senses=senses[ent_seq])
+    return entries
+
+
+def matched(params, field, text):
+    """[start, end] of the part of text the search matched, or None."""
+    if params['field'] != field:
+        return None
+    pattern = params['query']
+    if not params['regexp']:
+        pattern = re.escape(pattern)
+    if params['extent'] == 'whole':
+        pattern = '^(?:%s)$' % pattern
+    elif params['extent'] == 'word':
+        pattern = r'\b(?:%s)\b' % pattern
+    flags = 0 if params['case_sensitive'] else re.IGNORECASE
+    try:
+        match = re.search(pattern, text, flags)
+    except re.error:
+        return None
+    if match is None or match.start() == match.end():
+        return None
+    return [match.start(), match.end()]
+
+
+def sense_tags(sense):
+    # the same tag string as orm.Sense.tagstr, without the colors
+    tags = [tag for tag in (sense.pos, sense.field, sense.misc, sense.dial)
+            if tag]
+    parts = []
+    if tags:
+        parts.append('[%s]' % ';'.join(tags))
+    if sense.s_inf:
+        parts.append('[%s]' % sense.s_inf)
+    if sense.stagk or sense.stagr:
+        parts.append('〔%s〕' % '、'.join(sense.stagk + sense.stagr))
+    return ' '.join(parts)
+
+
+def structure(entry, params, romajifn=None):
+    """Plain-data form of an orm.Entry.
+
+    The result holds only dicts, lists, strings and numbers, so it
+    pickles and serializes to JSON cheaply. Parts of headwords and
+    glosses that matched the search are given as [start, end] offsets
+    under "match". EntryFormat lays it out for display.
+    """
+    readings = []
+    for reading in entry.readings:
+        text = romajifn(reading.text) if romajifn else reading.text
+        readings.append({'text': text,
+                         'info': reading.re_inf,
+                         'nokanji': bool(reading.re_nokanji),
+                         'restrictions': list(reading.re_restr),
+                         'match': matched(params, 'reading', text)})
+    return {'ent_seq': entry.ent_seq,
+            'frequent': bool(entry.frequent),
+            'kanjis': [{'text': kanji.text,
+                        'info': kanji.ke_inf,
+                        'match': matched(params, 'kanji', kanji.text)}
+                       for kanji in entry.kanjis],
+            'readings': readings,
+            'senses': [{'tags': sense_tags(sense),
+                        'glosses': [{'text': gloss,
+                                     'match': matched(params, 'gloss',
+                                                      gloss)}
+                                    for gloss in sense.glosses]}
+                       for sense in entry.senses]}
+
+
+def script_class(query):
+    if tt.is_latin(query):
+        return 'latin'
+    elif tt.is_romaji(query):
+        return 'romaji'
+    elif tt.is_kana(query):
+        return 'kana'
+    else:
+        return 'kanji'
+
+
+class LookupEngine:
+    """In-process myougiden lookups.
+
+    Database handles are opened once and kept for the life of the
+    engine, one case-insensitive and one case-sensitive. The search
+    conditions myougiden tries for a query only depend on its script
+    class and on whether it contains regexp characters, so they are
+    built once per combination and only have the query filled in.
+    Results are structured entries (see structure()), memoized in a
+    bounded LRU. Japanese queries go through a memory-mapped headword
+    index (see PrefixIndex) before falling back to myougiden's own
+    search.
+    """
+
+    # which fields to try first for each script class
+    field_order = {
+        # if pure alphabet, try as English first, then as rōmaji
+        'latin': ('gloss', 'reading', 'kanji'),
+        # latin with special chars; probably rōmaji
+        'romaji': ('reading', 'gloss', 'kanji'),
+        'kana': ('reading', 'kanji', 'gloss'),
+        'kanji': ('kanji', 'reading', 'gloss'),
+    }
+
+    def __init__(self, field='auto', extent='auto', regexp=False,
+                 frequent=False, out_romaji=None, cache_size=1024,
+                 use_index=True):
+        self.field = field
+        self.extent = extent
+        self.regexp = regexp
+        self.frequent = frequent
+        self.out_romaji = out_romaji
+        self.cache_size = cache_size
+        self.use_index = use_index
+        self.index = None
+        self.cache = OrderedDict()
+        self.handles = {}
+        self.plans = {}
+        self.hits = 0
+        self.misses = 0
+
+    def cursor(self, case_sensitive):
+        if case_sensitive not in self.handles:
+            self.handles[case_sensitive] = database.opendb(
+                case_sensitive=case_sensitive)
+        return self.handles[case_sensitive][1]
+
+    def prefix_index(self):
+        """The headword index, built from the database on first use."""
+        if self.index is None:
+            database_path = config.get('paths', 'database')
+            path = os.path.join(Paths.cache_dir("prefix"),
+                                Paths.file_key(database_path) + ".idx")
+            if not os.path.exists(path):
+                PrefixIndex.build(self.cursor(False), path)
+            self.index = PrefixIndex.PrefixIndex(path)
+        return self.index
+
+    def index_params(self, word):
+        # what search.guess would have chosen for an exact headword match
+        return {'query': word,
+                'field': 'reading' if tt.is_kana(word) else 'kanji',
+                'extent': 'whole',
+                'regexp': False,
+                'case_sensitive': False,
+                'frequent': False}
+
+    def segment(self, text):
+        """Split text into (word, entry ids) by greedy longest match.
+
+        Characters that start no headword are skipped.
+        """
+        index = self.prefix_index()
+        words = []
+        start = 0
+        while start < len(text):
+            (word, ent_seqs) = index.longest(text, start)
+            if word is None:
+                start += 1
+                continue
+            words.append((word, ent_seqs))
+            start += len(word)
+        return words
+
+    def index_search(self, query):
+        """Resolve a Japanese query through the headword index.
+
+        A query that is itself a headword gets all of its entries.
+        Anything longer, typically an OCR'd sentence, is segmented into
+        words and each word gets its most frequent entry. Returns a list
+        of (search params, entry ids), empty if nothing matched.
+        """
+        ent_seqs = self.prefix_index().lookup(query)
+        if ent_seqs:
+            return [(self.index_params(query), ent_seqs)]
+        return [(self.index_params(word), ent_seqs[:1])
+                for (word, ent_seqs) in self.segment(query)]
+
+    def close(self):
+        for (con, cur) in self.handles.values():
+            con.close()
+        self.handles = {}
+
+    def plan(self, script, regexp_special):
+        key = (script, regexp_special)
+        if key not in self.plans:
+            self.plans[key] = self.build_plan(script, regexp_special)
+        return self.plans[key]
+
+    def build_plan(self, script, regexp_special):
+        if self.field == 'auto':
+            fields = self.field_order[script]
         else:
-            print('Not found!')
-            sys.exit(0)
+            fields = (self.field,)
 
-    # handle query guesswork
-    if args.query == '':
-        ap.print_help()
-        sys.exit(2)
+        # 'word' doesn't work for Jap. anyway, and 'whole' is much faster.
+        extent = self.extent
+        if extent == 'word' and self.field in ('kanji', 'reading'):
+            extent = 'whole'
 
-    # 'word' doesn't work for Jap. anyway, and 'whole' is much faster.
-    if args.extent == 'word' and args.field in ('kanji', 'reading'):
-        args.extent = 'whole'
-
-    # first, we need a dictionary of options with only keys understood
-    # by search_by().
-    search_args = vars(args).copy()  # turn Namespace to dict
-    # keep only interesting keys
-    for k in list(search_args.keys()):
-        if k not in ('field', 'query', 'extent',
-                     'regexp', 'case_sensitive', 'frequent'):
-            del search_args[k]
-
-    # we'll iterate over all required 'field' and 'extent' conditions.
-    #
-    # for code clarity, we always use a list of search conditions,
-    # even if the size of the list is 1.
-
-    if args.field == 'auto':
-        if tt.is_latin(args.query):
-            # if pure alphabet, try as English first, then as rōmaji
-            fields = ('gloss', 'reading', 'kanji')
-        elif tt.is_romaji(args.query):
-            # latin with special chars; probably rōmaji
-            fields = ('reading', 'gloss', 'kanji')
-        elif tt.is_kana(args.query):
-            fields = ('reading', 'kanji', 'gloss')
+        if extent != 'auto':
+            extents = (extent,)
         else:
-            fields = ('kanji', 'reading', 'gloss')
-    else:
-        fields = (args.field,)
+            extents = ('whole', 'word', 'partial')
 
-    if args.extent != 'auto':
-        extents = (args.extent,)
-    else:
-        extents = ('whole', 'word', 'partial')
-
-    if args.regexp:
-        regexp_flags = (True,)
-    elif tt.has_regexp_special(args.query):
-        regexp_flags = (False, True)
-    else:
-        regexp_flags = (False,)
-
-    conditions = []
-    for regexp in regexp_flags:
-        for extent in extents:
-            for field in fields:
-
-                # the useless combination; we'll avoid it to avoid wasting
-                # time.
-                if extent == 'word' and field != 'gloss':
-
-                    if args.extent == 'auto':
-                        # we're trying all possibilities, so we can just
-                        # skip this one.  other extents were/will be tried
-                        # elsewhen in the loop.
-                        continue
-                    else:
+        if self.regexp:
+            regexp_flags = (True,)
+        elif regexp_special:
+            regexp_flags = (False, True)
+        else:
+            regexp_flags = (False,)
+
+        conditions = []
+        for regexp in regexp_flags:
+            for ext in extents:
+                for field in fields:
+                    cond_extent = ext
+                    # the useless combination; we'll avoid it to avoid
+                    # wasting time.
+                    if ext == 'word' and field != 'gloss':
+                        if extent == 'auto':
+                            # we're trying all possibilities, so we can
+                            # just skip this one.
+                            continue
                         # not trying all possibilities; this is our only
                         # pass in this field, so let's adjust it.
-                        sa = search_args.copy()
-                        sa['extent'] = 'whole'
-                else:
-                    # simple case.
-                    sa = search_args.copy()
-                    sa['extent'] = extent
-
-                sa['field'] = field
-                sa['regexp'] = regexp
-
-                conditions.append(sa)
-
-    # deal with rōmaji queries
-    if (args.field in ('auto', 'reading') and tt.is_romaji(args.query)):
-
-        if re.search('[A-Z]', args.query):
-            kana_guess = (romkan.to_katakana, romkan.to_hiragana)
-        else:
-            kana_guess = (romkan.to_hiragana, romkan.to_katakana)
-
-        new_conditions = conditions[:]
-        for oldcond in conditions:
-            if oldcond['field'] == 'reading':
-                for kanafn in kana_guess:
-                    # the query looks like romaji and the field is reading.
-                    # so we try it converted to kana _first_, then try as-is.
-                    # thus the insert.
+                        cond_extent = 'whole'
+                    conditions.append({'field': field,
+                                       'extent': cond_extent,
+                                       'regexp': regexp,
+                                       'frequent': self.frequent})
+        return tuple(conditions)
+
+    def conditions(self, query, case_sensitive):
+        plan = self.plan(script_class(query), tt.has_regexp_special(query))
+        conditions = []
+        for cond in plan:
+            cond = cond.copy()
+            cond['query'] = query
+            cond['case_sensitive'] = case_sensitive
+            conditions.append(cond)
+
+        # deal with rōmaji queries
+        if (self.field in ('auto', 'reading') and tt.is_romaji(query)):
+            if re.search('[A-Z]', query):
+                kana_guess = (romkan.to_katakana, romkan.to_hiragana)
+            else:
+                kana_guess = (romkan.to_hiragana, romkan.to_katakana)
+
+            new_conditions = conditions[:]
+            for oldcond in conditions:
+                if oldcond['field'] == 'reading':
+                    for kanafn in kana_guess:
+                        # the query looks like romaji and the field is
+                        # reading. so we try it converted to kana _first_,
+                        # then try as-is. thus the insert.
+                        for romaji in tt.expand_romaji(oldcond['query']):
+                            newcond = oldcond.copy()
+                            newcond['query'] = kanafn(romaji)
+                            new_conditions.insert(
+                                new_conditions.index(oldcond), newcond)
+            conditions = new_conditions
+        return conditions
+
+    def search(self, query):
+        """Yield the entries matching query one at a time."""
+        # case sensitivity must be handled before opening db
+        case_sensitive = re.search("[A-Z]", query) is not None
+        cur = self.cursor(case_sensitive)
+        results = []
+        if (self.use_index and self.field == 'auto' and not self.frequent
+                and script_class(query) in ('kana', 'kanji')
+                and not tt.has_regexp_special(query)):
+            results = self.index_search(query)
+        if len(results) == 0:
+            chosen_search, ent_seqs = search.guess(
+                cur, self.conditions(query, case_sensitive))
+            if not chosen_search:
+                return
+            results = [(chosen_search, ent_seqs)]
+
+        entries = fetch_entries(cur, [ent_seq
+                                      for (_, ent_seqs) in results
+                                      for ent_seq in ent_seqs])
+        for (chosen_search, ent_seqs) in results:
+            for ent_seq in ent_seqs:
+                yield structure(entries[ent_seq], chosen_search,
+                                self.out_romaji)
+
+    def entries(self, query):
+        """Yield entries, memoizing them once all are found."""
+        query = query.strip()
+        if len(query) == 0:
+            return
+        if query in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(query)
+            yield from self.cache[query]
+            return
+        self.misses += 1
+        found = []
+        for entry in self.search(query):
+            found.append(entry)
+            yield entry
+        self.cache[query] = tuple(found)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def lookup(self, query):
+        out = list(self.entries(query))
+        if len(out) == 0:
+            return None
+        return out
 
-                    for romaji in tt.expand_romaji(oldcond['query']):
-                        newcond = oldcond.copy()
-                        newcond['query'] = kanafn(romaji)
-                        new_conditions.insert(new_conditions.index(oldcond),
-                                              newcond)
-        conditions = new_conditions
 
-    chosen_search, ent_seqs = search.guess(cur, conditions)
+engine = None
 
-    if chosen_search:
-        entries = [orm.fetch_entry(cur, ent_seq) for ent_seq in ent_seqs]
 
-        if args.output_mode == 'human':
-            out = [entry.format_human(search_params=chosen_search,
-                   romajifn=args.out_romaji)
-                   for entry in entries]
+def get_engine():
+    global engine
+    if engine is None:
+        if not config:
+            print('ERROR: Could not find config.ini!')
+            print(common.version(None))
+            sys.exit(2)
+        engine = LookupEngine()
+    return engine
 
-            out = ("\n\n".join(out)) + "\n"
 
-        elif args.output_mode == 'tab':
-            out = [entry.format_tsv(search_params=chosen_search,
-                   romajifn=args.out_romaji)
-                   for entry in entries]
+def entries(query):
+    if len(query) == 0:
+        return
+    try:
+        yield from get_engine().entries(query)
+    except database.DatabaseAccessError as e:
+        print(database_help % (str(e), config.get('core', 'dbversion'),
+                               config.get('paths', 'database')))
+        sys.exit(2)
 
-            # out = ("\n".join(out)) + "\n"
 
-        return out
+def run(query, output_mode='human'):
+    """Entries for query as text: 'human' layout or 'tab' separated."""
+    if output_mode == 'human':
+        out = [EntryFormat.text(entry) for entry in entries(query)]
+        separator = "\n\n"
     else:
+        out = [EntryFormat.tsv(entry) for entry in entries(query)]
+        separator = "\n"
+    if len(out) == 0:
         return None
+    return separator.join(out) + "\n"
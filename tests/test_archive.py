@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Concurrent page reads from every archive backend.
+
+Run with: python -m unittest discover tests
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "benchmarks"))
+
+from Archive import Rar, Tar, Zip  # noqa: E402
+from PageCache import PageCache, PageLoader, Prefetcher  # noqa: E402
+import volumes  # noqa: E402
+
+threads = 8
+rounds = 4
+
+
+class ConcurrentReads(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        # tar indexes and extracted pages go to a cache of the test's own
+        cls.cache_home = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = os.path.join(cls.tmp.name, "cache")
+        cls.volumes = volumes.generate(cls.tmp.name, pages=12, width=240,
+                                       height=360)
+        tree = cls.volumes["tree"]
+        cls.pages = dict()
+        for name in sorted(os.listdir(tree)):
+            with open(os.path.join(tree, name), "rb") as page:
+                cls.pages[name] = page.read()
+        # members zipfile has to read itself, through per-thread handles
+        path = os.path.join(cls.tmp.name, "bzip2.cbz")
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_BZIP2) as volume:
+            for (name, data) in cls.pages.items():
+                volume.writestr(name, data)
+        cls.volumes["cbz-bzip2"] = path
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = cls.cache_home
+        cls.tmp.cleanup()
+
+    def check(self, archive):
+        with archive:
+            self.assertEqual(archive.list(), sorted(self.pages))
+
+            def read(name):
+                with archive.open(name) as page:
+                    opened = page.read()
+                return (name, bytes(archive.read(name)), opened)
+
+            names = list(self.pages) * rounds
+            with ThreadPoolExecutor(threads) as pool:
+                for (name, data, opened) in pool.map(read, names):
+                    self.assertEqual(data, self.pages[name], name)
+                    self.assertEqual(opened, self.pages[name], name)
+
+    def test_zip(self):
+        for label in ("cbz-stored", "cbz-deflated", "cbz-bzip2"):
+            with self.subTest(label):
+                self.check(Zip(self.volumes[label]))
+
+    def test_catalogued_zip(self):
+        self.check(Zip(self.volumes["cbz-stored"], pages=sorted(self.pages)))
+
+    def test_tar(self):
+        for label in ("tar", "tar-gz"):
+            with self.subTest(label):
+                self.check(Tar(self.volumes[label]))
+
+    @unittest.skipIf(shutil.which("rar") is None, "rar is not installed")
+    def test_rar(self):
+        self.check(Rar(self.volumes["cbr"]))
+
+    def test_prefetcher(self):
+        with Zip(self.volumes["cbz-deflated"]) as archive:
+            names = archive.list()
+            loader = PageLoader(archive, names)
+            cache = PageCache()
+            prefetcher = Prefetcher(loader, cache, distance=4, threads=3)
+            prefetcher.schedule(5, (120, 180), 0)
+            prefetcher.stop()
+            for thread in prefetcher.threads:
+                thread.join()
+            expected = PageLoader(archive, names)
+            for page in (1, 2, 3, 4, 6, 7, 8, 9):
+                image = cache.get((page, (120, 180), 0))
+                self.assertIsNotNone(image, page)
+                self.assertEqual(image.tobytes(),
+                                 expected.load(page, (120, 180), 0)
+                                 .tobytes(), page)
+
+
+if __name__ == "__main__":
+    unittest.main()
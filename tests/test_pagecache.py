@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Memory budget of the decoded-page pyramids.
+
+Run with: python -m unittest discover tests
+"""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from PIL import Image
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, root)
+
+from Archive import Zip  # noqa: E402
+from PageCache import PageLoader  # noqa: E402
+
+budget = 4 * 1024 * 1024
+
+
+class LargePage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "volume.cbz")
+        with zipfile.ZipFile(path, "w") as volume:
+            # a tall page whose pyramid alone is over budget, then two
+            # pages of ordinary size
+            for (name, size) in (("0.png", (1000, 4000)),
+                                 ("1.png", (400, 600)),
+                                 ("2.png", (400, 600))):
+                page = io.BytesIO()
+                Image.new("L", size, 128).save(page, "PNG")
+                volume.writestr(name, page.getvalue())
+        self.archive = Zip(path)
+        self.loader = PageLoader(self.archive, self.archive.list(),
+                                 pyramid_bytes=budget)
+
+    def tearDown(self):
+        self.archive.close()
+        self.tmp.cleanup()
+
+    def test_tile_holds_the_page_within_the_budget(self):
+        self.loader.tile(0, 1.0, 0, 0, 0)
+        (index, pyramid) = self.loader.large
+        self.assertEqual(index, 0)
+        self.assertLessEqual(self.loader.pyramids.max_bytes,
+                             max(0, budget - pyramid.nbytes))
+        # the next tile of the same page does not decode it again
+        self.loader.tile(0, 1.0, 0, 0, 1)
+        self.assertIs(self.loader.large[1], pyramid)
+
+    def test_release_restores_the_budget(self):
+        self.loader.tile(0, 1.0, 0, 0, 0)
+        self.loader.release_large(keep=0)
+        self.assertEqual(self.loader.large[0], 0)
+        self.loader.release_large()
+        self.assertEqual(self.loader.large, (None, None))
+        self.assertEqual(self.loader.pyramids.max_bytes, budget)
+        # fitted pages are cached as pyramids again
+        self.loader.load(1, (200, 300), 0)
+        self.loader.load(2, (200, 300), 0)
+        self.assertEqual(len(self.loader.pyramids), 2)
+
+    def test_fitted_loads_keep_the_large_page(self):
+        self.loader.tile(0, 1.0, 0, 0, 0)
+        self.loader.load(1, (200, 300), 0)
+        self.assertEqual(self.loader.large[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()